@@ -1,31 +1,41 @@
 import os
 import sqlite3
 import sys 
+import tempfile
+import time
+import functools
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from flask import (
     Flask, current_app, flash, render_template, request, redirect, url_for, session, g,
     jsonify, send_file 
 )
 from uuid import uuid4 
-from io import BytesIO
 import openpyxl 
-from openpyxl.styles import Font, Alignment
+from openpyxl.styles import Font, Alignment, NamedStyle
 from openpyxl.utils import get_column_letter
+from openpyxl.cell import WriteOnlyCell
 
 try:
-    from models import connect_db, init_db, get_next_barcode, create_discount, get_all_discounts, get_discount, get_next_bill_number
+    from models import init_db, get_next_barcode, create_discount, get_all_discounts, get_discount, get_next_bill_number, acquire_connection, release_connection, products_fts_enabled, set_database_path
 except ImportError:
-    print("Error: models.py not found or missing required functions (connect_db, init_db, get_next_barcode, create_discount, get_all_discounts, get_discount, get_next_bill_number).")
+    print("Error: models.py not found or missing required functions (init_db, get_next_barcode, create_discount, get_all_discounts, get_discount, get_next_bill_number, acquire_connection, release_connection, products_fts_enabled, set_database_path).")
     exit(1)
 
 try:
-    from utils import generate_barcode, get_sales_analytics, get_custom_range_analytics 
+    from utils import (
+        generate_barcode, get_sales_analytics,
+        get_cached_sales_analytics, get_cached_custom_range_analytics, get_sales_analytics_bulk,
+        clear_analytics_cache, DASHBOARD_METRICS
+    )
 except ImportError:
-    print("Error: utils.py not found or missing required functions (generate_barcode, get_sales_analytics, get_custom_range_analytics).")
+    print("Error: utils.py not found or missing required functions (generate_barcode, get_sales_analytics, get_cached_sales_analytics, get_cached_custom_range_analytics, get_sales_analytics_bulk, clear_analytics_cache, DASHBOARD_METRICS).")
     exit(1)
 
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
-import traceback # For detailed error logging
+import logging
 
 # --- PyInstaller Resource Path ---
 def resource_path(relative_path):
@@ -46,9 +56,21 @@ else:
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'your_super_secret_key_CHANGE_THIS_LATER_!@#$')
 app.permanent_session_lifetime = timedelta(hours=8)
 app.config['SESSION_TYPE'] = 'filesystem'
+# Error paths log through app.logger; FLASK_DEBUG=1 opts back into debug-level output
+app.logger.setLevel(logging.DEBUG if os.environ.get('FLASK_DEBUG') == '1' else logging.WARNING)
+
+# Verified against when a username doesn't exist, so failed logins take the same time either way
+DUMMY_PASSWORD_HASH = generate_password_hash(uuid4().hex)
 
 # --- Database Setup ---
+# Optional override of instance/toystore.db, e.g. TOYSTORE_DB_PATH=:memory: for tests
+app.config['DB_PATH'] = os.environ.get('TOYSTORE_DB_PATH')
+if app.config['DB_PATH']:
+    set_database_path(app.config['DB_PATH'])
+
 def get_database_path_for_init_check():
+    if app.config['DB_PATH']:
+        return app.config['DB_PATH']
     if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
         persistent_data_dir = os.path.dirname(sys.executable)
         return os.path.join(persistent_data_dir, 'instance', 'toystore.db')
@@ -56,18 +78,21 @@ def get_database_path_for_init_check():
         return os.path.join(os.path.abspath("."), 'instance', 'toystore.db')
 
 DATABASE_FOR_CHECK = get_database_path_for_init_check()
+SQLITE_SUPPORTS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+SQLITE_SUPPORTS_UPDATE_FROM = sqlite3.sqlite_version_info >= (3, 33, 0)
 
 # Initial DB check and creation before app context is fully available
 # This runs once at startup.
 if not os.path.exists(DATABASE_FOR_CHECK):
     try:
         print(f"Database not found at {DATABASE_FOR_CHECK}, initializing...")
-        os.makedirs(os.path.dirname(DATABASE_FOR_CHECK), exist_ok=True)
+        if os.path.dirname(DATABASE_FOR_CHECK):
+            os.makedirs(os.path.dirname(DATABASE_FOR_CHECK), exist_ok=True)
         init_db() 
         print("Database initialized at startup.")
     except Exception as e:
         print(f"Error initializing database at startup: {e}")
-        traceback.print_exc()
+        app.logger.exception("Error initializing database at startup")
         exit(1)
 else:
     # Database file exists. Run init_db() to ensure tables are created if missing.
@@ -78,14 +103,13 @@ else:
         print("Database tables checked/ensured at startup.")
     except Exception as e:
         print(f"Error running init_db() for existing database at startup: {e}")
-        traceback.print_exc()
+        app.logger.exception("Error running init_db() for existing database at startup")
         exit(1)
 
 
 def get_db():
     if not hasattr(g, 'sqlite_db'):
-        g.sqlite_db = connect_db()
-        g.sqlite_db.row_factory = sqlite3.Row
+        g.sqlite_db = acquire_connection() # Pooled; row_factory already sqlite3.Row
     return g.sqlite_db
 
 @app.before_request
@@ -94,21 +118,47 @@ def before_request_db():
         get_db()
     except sqlite3.Error as e:
         print(f"Database connection error in before_request: {e}")
-        traceback.print_exc()
+        app.logger.exception("Error in before_request_db")
         flash("Database connection failed. Please try again later.", "danger")
 
 @app.teardown_request
 def teardown_request_db(exception): 
-    db = getattr(g, 'sqlite_db', None)
+    db = g.pop('sqlite_db', None)
     if db is not None:
-        db.close()
+        if not db.in_transaction:
+            try: db.execute("PRAGMA optimize") # Usually a no-op; refreshes planner stats when they go stale
+            except sqlite3.Error: pass
+        release_connection(db) # Back to the pool rather than closing
+
+class _LazyUtcNow:
+    """
+    Stands in for datetime.utcnow() in templates. The clock is only read the first
+    time a template touches `now` (now.year, now.strftime(...), {{ now }}), so
+    renders that never use it skip the call entirely.
+    """
+    def __init__(self):
+        self._value = None
+
+    def _resolve(self):
+        if self._value is None:
+            self._value = datetime.utcnow()
+        return self._value
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __call__(self):
+        return self._resolve()
+
+    def __str__(self):
+        return str(self._resolve())
 
 @app.context_processor
 def inject_user_role_now():
     return dict(
         user=session.get('user'),
         role=session.get('role'),
-        now=datetime.utcnow()
+        now=_LazyUtcNow()
     )
 
 # --- Core Routes (Auth, Dashboard) ---
@@ -131,7 +181,7 @@ def register():
             allow_registration = True
     except sqlite3.Error as e:
         flash(f"Database error checking user count: {e}", "danger")
-        traceback.print_exc()
+        app.logger.exception("Error in register")
 
     if not allow_registration:
          flash("Registration is currently restricted.", "warning")
@@ -148,28 +198,36 @@ def register():
         
         cur = db.cursor()
         try:
-            cur.execute("SELECT id FROM users WHERE username=?", (username,))
-            if cur.fetchone():
+            password_hash = generate_password_hash(password_input)
+            if SQLITE_SUPPORTS_RETURNING:
+                # One atomic statement: no row comes back when the username is already taken
+                cur.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?) ON CONFLICT(username) DO NOTHING RETURNING id",
+                          (username, password_hash, role))
+                username_taken = not cur.fetchall()
+            else:
+                cur.execute("SELECT id FROM users WHERE username=?", (username,))
+                username_taken = cur.fetchone() is not None
+                if not username_taken:
+                    cur.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
+                              (username, password_hash, role))
+            if username_taken:
                 flash(f"Username '{username}' already exists. Please choose another.", "warning")
                 return render_template('register.html')
-            
-            password_hash = generate_password_hash(password_input)
-            cur.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
-                      (username, password_hash, role))
             db.commit()
             flash("User registered successfully. Please login.", "success")
             return redirect(url_for('login'))
         except sqlite3.Error as e:
             db.rollback()
             flash(f"Database error during registration: {e}", "danger")
-            traceback.print_exc()
+            app.logger.exception("Error in register")
         except Exception as e:
              flash(f"An unexpected error occurred during registration: {e}", "danger")
-             traceback.print_exc()
+             app.logger.exception("Error in register")
     return render_template('register.html')
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
+    # An authenticated session skips the (deliberately slow) password hash check entirely
     if 'user' in session:
         return redirect(url_for('dashboard'))
     if request.method == 'POST':
@@ -186,7 +244,8 @@ def login():
         try:
             cur.execute("SELECT id, username, password, role FROM users WHERE username=?", (username,))
             user = cur.fetchone()
-            if user and check_password_hash(user['password'], password_input):
+            password_ok = check_password_hash(user['password'] if user else DUMMY_PASSWORD_HASH, password_input)
+            if user and password_ok:
                 session.permanent = True
                 session['user'] = user['username']
                 session['user_id'] = user['id'] 
@@ -197,14 +256,15 @@ def login():
                 flash("Login failed: Incorrect username or password.", "danger")
         except sqlite3.Error as e:
              flash(f"Database error during login: {e}", "danger")
-             traceback.print_exc()
+             app.logger.exception("Error in login")
         except Exception as e:
              flash(f"An unexpected error occurred during login: {e}", "danger")
-             traceback.print_exc()
+             app.logger.exception("Error in login")
     return render_template('login.html')
 
 @app.route('/logout')
 def logout():
+    _discard_cart()
     session.clear()
     flash("You have been logged out.", "info")
     return redirect(url_for('login'))
@@ -222,12 +282,20 @@ def dashboard():
                                weekly_sales=[], monthly_sales=[], yearly_sales=[],
                                custom_range_analytics=None, from_date_filter=None, to_date_filter=None)
     
-    best_sellers = get_sales_analytics(db, 'best_sellers')
-    unsold_products = get_sales_analytics(db, 'unsold')
-    daily_sales = get_sales_analytics(db, 'daily')
-    weekly_sales = get_sales_analytics(db, 'weekly')
-    monthly_sales = get_sales_analytics(db, 'monthly')
-    yearly_sales = get_sales_analytics(db, 'yearly')
+    # Refresh/polling calls (?partial=daily etc.) get just that metric as JSON, skipping the other queries
+    partial = request.args.get('partial')
+    if partial:
+        if partial not in DASHBOARD_METRICS:
+            return jsonify({"success": False, "message": f"Unknown dashboard metric '{partial}'."}), 400
+        return jsonify({"success": True, "metric": partial, "data": get_cached_sales_analytics(db, partial)})
+
+    analytics = get_sales_analytics_bulk(db)
+    best_sellers = analytics['best_sellers']
+    unsold_products = analytics['unsold']
+    daily_sales = analytics['daily']
+    weekly_sales = analytics['weekly']
+    monthly_sales = analytics['monthly']
+    yearly_sales = analytics['yearly']
 
     from_date_filter = request.args.get('from_date')
     to_date_filter = request.args.get('to_date')
@@ -240,7 +308,7 @@ def dashboard():
             if from_dt > to_dt:
                 flash("From Date cannot be after To Date for custom analytics.", "warning")
             else:
-                custom_range_analytics = get_custom_range_analytics(db, from_date_filter, to_date_filter)
+                custom_range_analytics = get_cached_custom_range_analytics(db, from_date_filter, to_date_filter)
                 if custom_range_analytics and custom_range_analytics.get("error"):
                     flash(f"Error fetching custom range analytics: {custom_range_analytics['error']}", "danger")
                     custom_range_analytics = None 
@@ -248,7 +316,7 @@ def dashboard():
             flash("Invalid date format for custom analytics. Please use YYYY-MM-DD.", "warning")
         except Exception as e:
             flash(f"Error processing custom date range: {e}", "danger")
-            traceback.print_exc()
+            app.logger.exception("Error in dashboard")
             custom_range_analytics = None
 
     return render_template(
@@ -264,6 +332,44 @@ def dashboard():
         to_date_filter=to_date_filter     
     )
 
+HEADER_FONT = Font(bold=True) # Shared by every bold header cell in the XLSX exports
+HEADER_STYLE_NAME = 'header'
+
+def _new_export_workbook():
+    """
+    Write-only workbook with the 'header' named style registered, so header cells
+    reference one stored style instead of each carrying its own font.
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    wb.add_named_style(NamedStyle(name=HEADER_STYLE_NAME, font=HEADER_FONT))
+    return wb
+
+def _bold_cell(ws, value):
+    """Bold cell for a write-only worksheet (styles can't be set after append)."""
+    cell = WriteOnlyCell(ws, value=value)
+    cell.style = HEADER_STYLE_NAME
+    return cell
+
+def _send_workbook(wb, download_name):
+    """
+    Saves the workbook to an anonymous temp file and sends that open file, letting the
+    WSGI server use its file wrapper (sendfile) instead of holding the bytes in memory.
+    TemporaryFile has no directory entry on POSIX and is deleted on close on Windows, so
+    nothing is left behind once send_file's wrapper closes it. (send_file responses are
+    direct_passthrough, so a call_on_close hook would never run.)
+    """
+    tmp = tempfile.TemporaryFile(suffix='.xlsx')
+    try:
+        wb.save(tmp) # openpyxl writes through zipfile, which accepts an open file
+        tmp.seek(0)
+        return send_file(
+            tmp, as_attachment=True, download_name=download_name,
+            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        )
+    except Exception:
+        tmp.close()
+        raise
+
 @app.route('/export-dashboard-custom-range')
 def export_dashboard_custom_range():
     if 'user' not in session:
@@ -283,15 +389,17 @@ def export_dashboard_custom_range():
         return redirect(url_for('dashboard'))
 
     try:
-        analytics_data = get_custom_range_analytics(db, from_date_str, to_date_str)
+        analytics_data = get_cached_custom_range_analytics(db, from_date_str, to_date_str)
         if not analytics_data or analytics_data.get("error"):
             flash(f"Could not fetch data for export: {analytics_data.get('error', 'Unknown error')}", "danger")
             return redirect(url_for('dashboard', from_date=from_date_str, to_date=to_date_str))
 
-        wb = openpyxl.Workbook()
+        # Write-only workbook: rows are streamed into the archive instead of kept as editable cells
+        wb = _new_export_workbook()
         
-        ws_summary = wb.active
-        ws_summary.title = "Custom Range Summary"
+        ws_summary = wb.create_sheet(title="Custom Range Summary")
+        ws_summary.column_dimensions['A'].width = 30
+        ws_summary.column_dimensions['B'].width = 20
         headers_summary = [
             ("Metric", "Value"),
             ("Date Range", f"{from_date_str} to {to_date_str}"),
@@ -310,43 +418,93 @@ def export_dashboard_custom_range():
             ("Avg. Items per Bill", f"{analytics_data.get('avg_items_per_bill', 0):.2f}"),
             ("Avg. Bill Value (Net, ₹)", f"{analytics_data.get('avg_bill_value_net', 0):.2f}"),
         ]
-        for row_idx, (header, value) in enumerate(headers_summary, 1):
-            ws_summary.cell(row=row_idx, column=1, value=header).font = Font(bold=True)
-            ws_summary.cell(row=row_idx, column=2, value=value)
-        ws_summary.column_dimensions['A'].width = 30
-        ws_summary.column_dimensions['B'].width = 20
+        for header, value in headers_summary:
+            ws_summary.append([_bold_cell(ws_summary, header), value])
 
+        # Column widths must be set before the first append on a write-only sheet
         ws_top_qty = wb.create_sheet(title="Top Sellers (Net Qty)")
-        ws_top_qty.append(["Product ID", "Product Name", "Gross Sold Qty", "Returned Qty", "Net Sold Qty"])
-        for cell in ws_top_qty[1]: cell.font = Font(bold=True)
+        for col_letter in ['A', 'B', 'C', 'D', 'E']: 
+            ws_top_qty.column_dimensions[col_letter].width = 15 if col_letter not in ['B'] else 35
+        ws_top_qty.append([_bold_cell(ws_top_qty, h) for h in ["Product ID", "Product Name", "Gross Sold Qty", "Returned Qty", "Net Sold Qty"]])
         for item in analytics_data.get('top_sellers_by_net_qty', []):
             ws_top_qty.append([item['id'], item['name'], item['gross_sold_qty'], item['returned_qty'], item['net_sold_qty']])
-        for i, col_letter in enumerate(['A', 'B', 'C', 'D', 'E']): 
-            ws_top_qty.column_dimensions[col_letter].width = 15 if col_letter not in ['B'] else 35
         
         ws_top_rev = wb.create_sheet(title="Top Sellers (Gross Rev)")
-        ws_top_rev.append(["Product ID", "Product Name", "Gross Revenue (₹)", "Gross Sold Qty", "Returned Qty"])
-        for cell in ws_top_rev[1]: cell.font = Font(bold=True)
-        for item in analytics_data.get('top_sellers_by_gross_revenue', []):
-            ws_top_rev.append([item['id'], item['name'], f"{item['gross_revenue']:.2f}", item['gross_sold_qty'], item['returned_qty']])
-        for i, col_letter in enumerate(['A', 'B', 'C', 'D', 'E']): 
+        for col_letter in ['A', 'B', 'C', 'D', 'E']: 
             ws_top_rev.column_dimensions[col_letter].width = 20 if col_letter not in ['B'] else 35
             if col_letter == 'C': ws_top_rev.column_dimensions[col_letter].number_format = '"₹"#,##0.00'
+        ws_top_rev.append([_bold_cell(ws_top_rev, h) for h in ["Product ID", "Product Name", "Gross Revenue (₹)", "Gross Sold Qty", "Returned Qty"]])
+        for item in analytics_data.get('top_sellers_by_gross_revenue', []):
+            ws_top_rev.append([item['id'], item['name'], f"{item['gross_revenue']:.2f}", item['gross_sold_qty'], item['returned_qty']])
 
-        excel_buffer = BytesIO()
-        wb.save(excel_buffer)
-        excel_buffer.seek(0)
-        return send_file(
-            excel_buffer, as_attachment=True,
-            download_name=f"custom_analytics_{from_date_str}_to_{to_date_str}.xlsx",
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
+        return _send_workbook(wb, f"custom_analytics_{from_date_str}_to_{to_date_str}.xlsx")
     except Exception as e:
         flash(f"Error exporting custom range data: {e}", "danger")
-        traceback.print_exc()
+        app.logger.exception("Error in export_dashboard_custom_range")
         return redirect(url_for('dashboard', from_date=from_date_str, to_date=to_date_str))
 
 # --- Product Management Routes ---
+_barcode_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='barcode')
+
+def _generate_barcode_in_background(product_code, output_filename_base):
+    """Runs generate_barcode() on _barcode_executor. The product row is already saved, so failures are only logged."""
+    try:
+        generate_barcode(product_code, output_filename_base)
+    except Exception:
+        app.logger.exception("Background barcode generation failed for '%s'", product_code)
+
+# Bumped after every committed catalog change. The dropdown caches below are keyed on it rather
+# than just cleared, so a read that started before a write can only store its (stale) result
+# under the old version, which is never asked for again
+CATALOG_VERSION = 0
+_catalog_version_lock = threading.Lock()
+
+def _bump_catalog_version():
+    global CATALOG_VERSION
+    with _catalog_version_lock:
+        CATALOG_VERSION += 1
+
+def _load_categories():
+    """
+    Category dropdown rows as plain dicts, cached per CATALOG_VERSION.
+    Categories only change through add_category, which bumps the version.
+    """
+    return _load_categories_for_version(CATALOG_VERSION)
+
+@functools.lru_cache(maxsize=8)
+def _load_categories_for_version(catalog_version):
+    cur = get_db().cursor()
+    cur.execute("SELECT id, name FROM categories ORDER BY name")
+    return [{'id': row['id'], 'name': row['name']} for row in cur.fetchall()]
+
+def _load_billing_products():
+    """
+    In-stock products for the billing dropdown. Every scan redirects back to /billing,
+    so this is cached per CATALOG_VERSION, which the routes that change products or stock bump.
+    """
+    return _load_billing_products_for_version(CATALOG_VERSION)
+
+@functools.lru_cache(maxsize=8)
+def _load_billing_products_for_version(catalog_version):
+    cur = get_db().cursor()
+    cur.execute("SELECT id, name, selling_price FROM products WHERE quantity > 0 ORDER BY name COLLATE NOCASE")
+    return cur.fetchall()
+
+# Inserts nothing (instead of raising) when the category is missing or the barcode is taken
+SQL_INSERT_PRODUCT = """INSERT INTO products (name, cost_price, selling_price, quantity, category_id, barcode) 
+                   SELECT ?, ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM categories WHERE id = ?)
+                   ON CONFLICT(barcode) DO NOTHING"""
+
+def _insert_product(cur, name, cost_price, selling_price, qty, cat_id, barcode_value):
+    """Inserts a product; returns its id, or None when the category is missing or the barcode is taken."""
+    params = (name, cost_price, selling_price, qty, cat_id, barcode_value, cat_id)
+    if SQLITE_SUPPORTS_RETURNING:
+        cur.execute(SQL_INSERT_PRODUCT + " RETURNING id", params)
+        inserted = cur.fetchall() # Drain RETURNING fully so the statement is finished before commit
+        return inserted[0][0] if inserted else None
+    cur.execute(SQL_INSERT_PRODUCT, params)
+    return cur.lastrowid if cur.rowcount == 1 else None
+
 @app.route('/add-product', methods=['GET', 'POST'])
 def add_product():
     if 'user' not in session:
@@ -358,11 +516,10 @@ def add_product():
     cur = db.cursor()
     categories = []
     try:
-        cur.execute("SELECT id, name FROM categories ORDER BY name")
-        categories = cur.fetchall()
+        categories = _load_categories()
     except sqlite3.Error as e: 
         flash(f"Could not load categories: {e}", "danger")
-        traceback.print_exc()
+        app.logger.exception("Error in add_product")
         categories = []
 
     if request.method == 'POST':
@@ -394,59 +551,59 @@ def add_product():
         
         try:
             if cat_id_str:
-                cat_id = int(cat_id_str)
-                cur.execute("SELECT id FROM categories WHERE id = ?", (cat_id,))
-                if not cur.fetchone(): errors.append("Selected category does not exist.")
+                cat_id = int(cat_id_str) # Existence is checked by the INSERT itself
             else:
                 errors.append("Category is required.")
         except ValueError: errors.append("Invalid category selected.")
         
-        final_code = None
-        if not code: 
+        # Barcode uniqueness is enforced by the INSERT itself (ON CONFLICT ... RETURNING), so there is
+        # no separate check that could race another add
+        final_code = code
+        if not errors and not code:
             try:
                 final_code = get_next_barcode()
-                cur.execute("SELECT id FROM products WHERE barcode = ?", (final_code,))
-                if cur.fetchone(): 
-                    errors.append(f"Generated barcode '{final_code}' already exists. Please try saving again or enter a unique one."); final_code = None
             except Exception as e: 
                 errors.append(f"Could not auto-generate barcode: {e}"); final_code = None
-                traceback.print_exc()
-        else: 
-             cur.execute("SELECT id FROM products WHERE barcode = ?", (code,))
-             if cur.fetchone(): 
-                 errors.append(f"Barcode '{code}' already exists. Use a unique barcode or leave blank to auto-generate."); final_code = None
-             else: 
-                 final_code = code
+                app.logger.exception("Error in add_product")
         
         if errors:
             for error in errors: flash(error, 'danger')
         elif final_code:
-            barcode_image_path_base = None
-            generated_barcode_file_full_path = None
             try:
-                barcode_dir_for_saving = os.path.join(app.static_folder, 'barcodes')
-                os.makedirs(barcode_dir_for_saving, exist_ok=True)
-                barcode_image_path_base = os.path.join(barcode_dir_for_saving, final_code) 
-                generated_barcode_file_full_path = generate_barcode(final_code, barcode_image_path_base)
-                
-                cur.execute("INSERT INTO products (name, cost_price, selling_price, quantity, category_id, barcode) VALUES (?, ?, ?, ?, ?, ?)", 
-                              (name, cost_price, selling_price, qty, cat_id, final_code))
+                db.execute('BEGIN IMMEDIATE')
+                inserted = _insert_product(cur, name, cost_price, selling_price, qty, cat_id, final_code)
+                if inserted is None and not code:
+                    # Auto-generated code collided (e.g. a zero-padded duplicate); try the next one once
+                    final_code = str(int(final_code) + 1).zfill(12)
+                    inserted = _insert_product(cur, name, cost_price, selling_price, qty, cat_id, final_code)
+                if inserted is None:
+                    db.rollback()
+                    # Nothing inserted: either the category is missing or the barcode is taken
+                    cur.execute("SELECT 1 FROM categories WHERE id = ?", (cat_id,))
+                    if not cur.fetchone():
+                        flash("Selected category does not exist.", 'danger')
+                    elif code:
+                        flash(f"Barcode '{code}' already exists. Use a unique barcode or leave blank to auto-generate.", 'danger')
+                    else:
+                        flash(f"Generated barcode '{final_code}' already exists. Please try saving again or enter a unique one.", 'danger')
+                    return render_template('add_product.html', categories=categories)
                 db.commit()
+                clear_analytics_cache()
+                _bump_catalog_version()
+
+                # The PNG is rendered after the commit, off the request thread
+                barcode_image_path_base = os.path.join(app.static_folder, 'barcodes', final_code)
+                _barcode_executor.submit(_generate_barcode_in_background, final_code, barcode_image_path_base)
                 flash(f"Product '{name}' added with barcode {final_code}", 'success')
                 return redirect(url_for('product_list'))
             except sqlite3.Error as e:
-                db.rollback()
+                if db.in_transaction: db.rollback()
                 flash(f"Database error adding product: {e}", 'danger')
-                traceback.print_exc()
-                if generated_barcode_file_full_path and os.path.exists(generated_barcode_file_full_path):
-                    try: os.remove(generated_barcode_file_full_path)
-                    except OSError as file_err: print(f"Error removing barcode file {generated_barcode_file_full_path} on DB error: {file_err}")
+                app.logger.exception("Error in add_product")
             except Exception as e:
+                 if db.in_transaction: db.rollback()
                  flash(f"An unexpected error occurred: {e}", 'danger')
-                 traceback.print_exc()
-                 if generated_barcode_file_full_path and os.path.exists(generated_barcode_file_full_path):
-                    try: os.remove(generated_barcode_file_full_path)
-                    except OSError as file_err: print(f"Error removing barcode file {generated_barcode_file_full_path} on general error: {file_err}")
+                 app.logger.exception("Error in add_product")
     return render_template('add_product.html', categories=categories)
 
 @app.route('/add-category', methods=['GET', 'POST'])
@@ -467,6 +624,8 @@ def add_category():
             try:
                 cur.execute("INSERT INTO categories (name) VALUES (?)", (category_name,))
                 db.commit()
+                clear_analytics_cache()
+                _bump_catalog_version()
                 flash(f"Category '{category_name}' added successfully.", "success")
                 return redirect(url_for('dashboard')) 
             except sqlite3.IntegrityError: 
@@ -475,12 +634,44 @@ def add_category():
             except sqlite3.Error as e: 
                 db.rollback()
                 flash(f"Database error adding category: {e}", "danger")
-                traceback.print_exc()
+                app.logger.exception("Error in add_category")
             except Exception as e: 
                 flash(f"An unexpected error occurred: {e}", "danger")
-                traceback.print_exc()
+                app.logger.exception("Error in add_category")
     return render_template('add_category.html')
 
+def _build_product_list_query(use_fts, has_search, has_category):
+    # Profit and margin are computed by SQLite so rows can be handed to the template as-is
+    query = """SELECT p.id, p.name,
+                      COALESCE(p.cost_price, 0.0) as cost_price, COALESCE(p.selling_price, 0.0) as selling_price,
+                      ROUND(COALESCE(p.selling_price, 0.0) - COALESCE(p.cost_price, 0.0), 2) as profit,
+                      CASE WHEN COALESCE(p.selling_price, 0.0) <> 0
+                           THEN ROUND((p.selling_price - COALESCE(p.cost_price, 0.0)) * 100.0 / p.selling_price, 2)
+                           ELSE 0 END as profit_margin,
+                      COALESCE(p.quantity, 0) as quantity, p.barcode,
+                      COALESCE(c.name, 'Uncategorized') as category_name, c.id as category_id 
+               FROM products p 
+               LEFT JOIN categories c ON p.category_id = c.id"""
+    conditions = []
+    if has_search:
+        if use_fts:
+            # Trigram FTS answers LIKE from its index (case-insensitive, same matches as below)
+            conditions.append("p.id IN (SELECT rowid FROM products_fts WHERE name LIKE ?)")
+        else:
+            conditions.append("p.name LIKE ? COLLATE NOCASE")
+    if has_category:
+        conditions.append("p.category_id = ?")
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    return query + " ORDER BY p.name COLLATE NOCASE"
+
+# Every product_list filter combination, built once so each request reuses identical SQL text
+# (and hits sqlite3's statement cache). Keyed by (use_fts, has_search, has_category).
+_PRODUCT_LIST_QUERIES = {
+    (use_fts, has_search, has_category): _build_product_list_query(use_fts, has_search, has_category)
+    for use_fts in (True, False) for has_search in (True, False) for has_category in (True, False)
+}
+
 @app.route('/products')
 def product_list():
     if 'user' not in session: flash("Please log in.", "warning"); return redirect(url_for('login'))
@@ -494,56 +685,36 @@ def product_list():
     category_filter_str = request.args.get('category', '')
     
     try:
-        cur.execute("SELECT id, name FROM categories ORDER BY name"); 
-        categories_list = cur.fetchall()
-        
-        query = """SELECT p.id, p.name, p.cost_price, p.selling_price, p.quantity, p.barcode, 
-                          c.name as category_name, c.id as category_id 
-                   FROM products p 
-                   LEFT JOIN categories c ON p.category_id = c.id"""
-        params = []
-        conditions = []
+        categories_list = _load_categories()
         
+        params = ()
         if search_term: 
-            conditions.append("p.name LIKE ? COLLATE NOCASE")
-            params.append(f"%{search_term}%")
+            params += (f"%{search_term}%",)
         
         if category_filter_str:
             try: 
-                selected_category_id = int(category_filter_str)
-                conditions.append("p.category_id = ?")
-                params.append(selected_category_id)
+                params += (int(category_filter_str),)
             except ValueError: 
                 flash("Invalid category filter value.", "warning")
                 category_filter_str = '' 
         
-        if conditions: 
-            query += " WHERE " + " AND ".join(conditions)
-        query += " ORDER BY p.name COLLATE NOCASE"
-        
+        query = _PRODUCT_LIST_QUERIES[(products_fts_enabled(), bool(search_term), bool(category_filter_str))]
         cur.execute(query, params)
-        for row in cur.fetchall():
-            cost = row['cost_price'] if row['cost_price'] is not None else 0.0
-            sell = row['selling_price'] if row['selling_price'] is not None else 0.0
-            profit = sell - cost
-            profit_margin = (profit / sell * 100) if sell != 0 else 0
-            
-            products_data.append({
-                'id': row['id'], 'name': row['name'], 'cost_price': cost, 'selling_price': sell, 
-                'profit': round(profit, 2), 'profit_margin': round(profit_margin, 2),
-                'quantity': row['quantity'] if row['quantity'] is not None else 0, 
-                'barcode': row['barcode'], 'category_name': row['category_name'] or 'Uncategorized', 
-                'category_id': row['category_id']
-            })
+        products_data = [dict(row) for row in cur.fetchall()]
     except sqlite3.Error as e: 
         flash(f"Error fetching product list: {e}", "danger")
-        traceback.print_exc()
+        app.logger.exception("Error in product_list")
         products_data = []; categories_list = []
         
     return render_template('product_list.html', 
                            products=products_data, categories=categories_list, 
                            search_term=search_term, selected_category=category_filter_str)
 
+def _stored_barcode(cur, product_id):
+    cur.execute("SELECT barcode FROM products WHERE id=?", (product_id,))
+    row = cur.fetchone()
+    return row['barcode'] if row and row['barcode'] else ''
+
 @app.route('/edit-product/<int:product_id>', methods=['GET', 'POST'])
 def edit_product(product_id):
     if 'user' not in session: flash("Please log in.", "warning"); return redirect(url_for('login'))
@@ -582,55 +753,58 @@ def edit_product(product_id):
         
         try:
             if cat_id_str:
-                category_id = int(cat_id_str)
-                cur.execute("SELECT id FROM categories WHERE id = ?", (category_id,))
-                if not cur.fetchone(): errors.append("Selected category does not exist.")
+                category_id = int(cat_id_str) # Existence is checked by the UPDATE itself
             else:
                 errors.append("Category is required.") 
         except ValueError: errors.append("Invalid category selected.")
         
+        # Error re-renders show what was submitted instead of re-reading the row. The barcode
+        # can't be edited (its readonly field isn't submitted), so it's filled from the stored row
+        # by _stored_barcode() just before a re-render
+        submitted_product = {
+            'id': product_id, 'name': name, 'cost_price': cost_price, 'selling_price': selling_price,
+            'quantity': quantity, 'category_id': category_id
+        }
+        
         if errors:
             for error in errors: flash(error, 'danger')
             try:
-                cur.execute("SELECT * FROM products WHERE id=?", (product_id,))
-                product = cur.fetchone()
-                cur.execute("SELECT id, name FROM categories ORDER BY name")
-                categories_list = cur.fetchall()
-                if not product: 
-                    flash("Product not found (while reloading form).", "warning")
-                    return redirect(url_for('product_list'))
-                return render_template('edit_product.html', product=product, categories=categories_list)
+                categories_list = _load_categories()
+                submitted_product['barcode'] = _stored_barcode(cur, product_id)
+                return render_template('edit_product.html', product=submitted_product, categories=categories_list)
             except Exception as fetch_err: 
                 flash(f"Error reloading form data after validation error: {fetch_err}", "danger")
-                traceback.print_exc()
+                app.logger.exception("Error in edit_product")
                 return redirect(url_for('product_list'))
         else: 
             try:
-                cur.execute("UPDATE products SET name=?, cost_price=?, selling_price=?, quantity=?, category_id=? WHERE id=?", 
-                              (name, cost_price, selling_price, quantity, category_id, product_id))
-                db.commit()
-                flash("Product updated successfully", "success")
-                return redirect(url_for('product_list'))
+                cur.execute("""UPDATE products SET name=?, cost_price=?, selling_price=?, quantity=?, category_id=? 
+                               WHERE id=? AND EXISTS (SELECT 1 FROM categories WHERE id = ?)""", 
+                              (name, cost_price, selling_price, quantity, category_id, product_id, category_id))
+                if cur.rowcount == 0:
+                    # Missing category (or product); the reload below reports a missing product
+                    flash("Selected category does not exist.", "danger")
+                else:
+                    db.commit()
+                    clear_analytics_cache()
+                    _bump_catalog_version()
+                    flash("Product updated successfully", "success")
+                    return redirect(url_for('product_list'))
             except sqlite3.Error as e: 
                 db.rollback()
                 flash(f"Database error updating product: {e}", "danger")
-                traceback.print_exc()
+                app.logger.exception("Error in edit_product")
                 try:
-                    cur.execute("SELECT * FROM products WHERE id=?", (product_id,))
-                    product = cur.fetchone() 
-                    cur.execute("SELECT id, name FROM categories ORDER BY name")
-                    categories_list = cur.fetchall()
-                    if not product:
-                         flash("Product not found (after DB error).", "warning")
-                         return redirect(url_for('product_list'))
-                    return render_template('edit_product.html', product=product, categories=categories_list)
+                    categories_list = _load_categories()
+                    submitted_product['barcode'] = _stored_barcode(cur, product_id)
+                    return render_template('edit_product.html', product=submitted_product, categories=categories_list)
                 except Exception as reload_err:
                     flash(f"Additional error reloading form after DB update error: {reload_err}", "danger")
                     return redirect(url_for('product_list'))
 
             except Exception as e: 
                 flash(f"An unexpected error occurred during product update: {e}", "danger")
-                traceback.print_exc()
+                app.logger.exception("Error in edit_product")
     
     try:
         cur.execute("SELECT * FROM products WHERE id=?", (product_id,))
@@ -639,15 +813,14 @@ def edit_product(product_id):
             flash("Product not found.", "warning")
             return redirect(url_for('product_list'))
         
-        cur.execute("SELECT id, name FROM categories ORDER BY name")
-        categories_list = cur.fetchall()
+        categories_list = _load_categories()
     except sqlite3.Error as e: 
         flash(f"Error fetching product details for editing: {e}", "danger")
-        traceback.print_exc()
+        app.logger.exception("Error in edit_product")
         return redirect(url_for('product_list')) 
     except Exception as e: 
         flash(f"An unexpected error occurred fetching product for edit: {e}", "danger")
-        traceback.print_exc()
+        app.logger.exception("Error in edit_product")
         return redirect(url_for('product_list')) 
     
     return render_template('edit_product.html', product=product, categories=categories_list)
@@ -662,26 +835,28 @@ def delete_product(product_id):
     if db is None: flash("Database unavailable.", "danger"); return redirect(url_for('product_list'))
     cur = db.cursor(); product_barcode = None
     try:
+        db.execute('BEGIN IMMEDIATE') # Usage checks and DELETE form one write transaction
         cur.execute("SELECT id, name, barcode FROM products WHERE id=?", (product_id,)); product_row = cur.fetchone()
-        if not product_row: flash("Product not found.", "warning"); return redirect(url_for('product_list'))
+        if not product_row: db.rollback(); flash("Product not found.", "warning"); return redirect(url_for('product_list'))
         
         product_name, product_barcode = product_row['name'], product_row['barcode']
         cur.execute("SELECT COUNT(*) FROM sales WHERE product_id = ?", (product_id,)); sales_count = cur.fetchone()[0]
         cur.execute("SELECT COUNT(*) FROM returns WHERE product_id = ?", (product_id,)); returns_count = cur.fetchone()[0]
         
         if sales_count > 0 or returns_count > 0:
+            db.rollback()
             flash(f"Cannot delete '{product_name}': It has associated sales ({sales_count}) or return ({returns_count}) records.", "warning")
             return redirect(url_for('product_list'))
         
-        cur.execute("DELETE FROM products WHERE id=?", (product_id,)); db.commit()
+        cur.execute("DELETE FROM products WHERE id=?", (product_id,)); db.commit(); clear_analytics_cache(); _bump_catalog_version()
         if product_barcode:
             try:
                 barcode_path = os.path.join(app.static_folder, 'barcodes', f"{product_barcode}.png")
                 if os.path.exists(barcode_path): os.remove(barcode_path); print(f"Deleted barcode image: {barcode_path}")
             except Exception as e: print(f"Warning: Could not delete barcode file {product_barcode}.png: {e}")
         flash(f"Product '{product_name}' deleted successfully.", "success")
-    except sqlite3.Error as e: db.rollback(); flash(f"Database error deleting product: {e}", "danger"); traceback.print_exc()
-    except Exception as e: flash(f"An unexpected error occurred: {e}", "danger"); traceback.print_exc()
+    except sqlite3.Error as e: db.rollback(); flash(f"Database error deleting product: {e}", "danger"); app.logger.exception("Error in delete_product")
+    except Exception as e: flash(f"An unexpected error occurred: {e}", "danger"); app.logger.exception("Error in delete_product")
     return redirect(url_for('product_list'))
 
 # --- Billing and Cart Routes ---
@@ -692,20 +867,134 @@ if os.name == 'nt':
 else: win32print = None 
 
 
+# --- Server-side Cart Store ---
+# Carts live in process memory keyed by a random id in the session, so the signed cookie
+# no longer re-serializes the whole cart on every scan. Least recently used carts are
+# evicted past CART_STORE_MAXSIZE; a restart empties in-progress carts.
+CART_STORE_MAXSIZE = 512
+_cart_store = OrderedDict()
+_cart_totals = {} # cart id -> gross total, refreshed by _save_cart() so page loads don't re-sum
+_cart_store_lock = threading.Lock()
+
+def _get_cart():
+    """
+    Returns the current session's cart, creating an empty one if needed. The cart is a dict of
+    product id -> item dict ('id', 'barcode', 'name', 'price', 'qty'), in the order items were added.
+    """
+    cart_id = session.get('cart_id')
+    if cart_id is None:
+        cart_id = session['cart_id'] = uuid4().hex
+    with _cart_store_lock:
+        cart = _cart_store.get(cart_id)
+        if cart is None:
+            cart = _cart_store[cart_id] = {}
+        _cart_store.move_to_end(cart_id)
+        while len(_cart_store) > CART_STORE_MAXSIZE: _cart_totals.pop(_cart_store.popitem(last=False)[0], None)
+    return cart
+
+def _save_cart(cart):
+    if 'cart_id' not in session: session['cart_id'] = uuid4().hex
+    total_gross = sum(item['price'] * item['qty'] for item in cart.values())
+    with _cart_store_lock:
+        _cart_store[session['cart_id']] = cart
+        _cart_store.move_to_end(session['cart_id'])
+        _cart_totals[session['cart_id']] = total_gross
+
+def _cart_total():
+    """Gross total of the current cart, summed only if no mutation has cached it yet."""
+    cart = _get_cart()
+    with _cart_store_lock: total_gross = _cart_totals.get(session['cart_id'])
+    if total_gross is None:
+        total_gross = sum(item['price'] * item['qty'] for item in cart.values())
+        with _cart_store_lock: _cart_totals[session['cart_id']] = total_gross
+    return total_gross
+
+def _discard_cart():
+    cart_id = session.get('cart_id')
+    if cart_id is not None:
+        with _cart_store_lock: _cart_store.pop(cart_id, None); _cart_totals.pop(cart_id, None)
+
+# --- Background Receipt Printing ---
+# A single worker keeps receipts in checkout order. Outcomes are kept by bill id until the
+# cashier's next /billing load flashes them (oldest dropped past PRINT_STATUS_MAXSIZE).
+_printer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='printer')
+PRINT_STATUS_MAXSIZE = 64
+_print_status = OrderedDict()
+_print_status_lock = threading.Lock()
+
+# Receipts from back-to-back checkouts are coalesced into one spool job: each flush waits
+# PRINT_BATCH_MS for more receipts to queue up, then sends everything waiting. Every payload
+# already starts with printer init and ends with a cut, so they simply concatenate.
+# 0 sends at once (receipts queued while the printer is busy still share a job).
+app.config['PRINT_BATCH_MS'] = int(os.environ.get('TOYSTORE_PRINT_BATCH_MS', '100'))
+_print_batch = [] # (bill_id, payload) waiting for the printer thread
+_print_batch_lock = threading.Lock()
+
+def _queue_receipt_for_printing(bill_id, receipt_bytes):
+    with _print_batch_lock: _print_batch.append((bill_id, receipt_bytes))
+    return _printer_executor.submit(_flush_print_batch, app.config['PRINT_BATCH_MS'] / 1000.0)
+
+def _flush_print_batch(wait_seconds=0):
+    """Runs on _printer_executor: sends all queued receipts as one job and records (success, message) per bill."""
+    if wait_seconds: time.sleep(wait_seconds)
+    with _print_batch_lock:
+        batch = _print_batch[:]; _print_batch.clear()
+    if not batch: return 0 # An earlier flush already sent these
+    try:
+        status = send_to_printer(b''.join(receipt_bytes for _bill_id, receipt_bytes in batch))
+    except Exception as e:
+        app.logger.exception("Error in _flush_print_batch")
+        status = (False, f"Printing error: {e}")
+    with _print_status_lock:
+        for bill_id, _receipt_bytes in batch: _print_status[bill_id] = status
+        while len(_print_status) > PRINT_STATUS_MAXSIZE: _print_status.popitem(last=False)
+    return len(batch)
+
+def _flash_finished_print_jobs():
+    """Flashes the outcome of this session's queued receipts that have finished printing."""
+    pending = session.get('pending_print_bills')
+    if not pending: return
+    still_pending = []
+    for bill_id in pending:
+        with _print_status_lock: status = _print_status.pop(bill_id, None)
+        if status is None: still_pending.append(bill_id); continue
+        print_success_flag, print_status_message = status
+        if print_success_flag: flash(f"Receipt for Bill No: {bill_id} printed successfully.", "info")
+        else: flash(f"Receipt printing for Bill No: {bill_id} status: {print_status_message}", "warning")
+    if len(still_pending) != len(pending): session['pending_print_bills'] = still_pending
+
+# Checkout/return statements keep one exact SQL text each, so every bill reuses the
+# connection's cached prepared statements instead of re-parsing
+# {values} is one "(?, ?)" (id, qty) group per cart product; returns the products that can't be filled.
+# Only run after a failed decrement, to name the item in the error.
+SQL_CHECK_STOCK = """WITH wanted(id, qty) AS (VALUES {values})
+                     SELECT wanted.id FROM wanted LEFT JOIN products p ON p.id = wanted.id
+                     WHERE p.id IS NULL OR p.quantity < wanted.qty"""
+SQL_INSERT_SALE = """INSERT INTO sales (bill_identifier, product_id, quantity, sale_price, sale_date, user_id, discount_applied_to_bill, payment_method) 
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
+SQL_INSERT_BILL = "INSERT INTO bills (bill_identifier, sale_date, discount) VALUES (?, ?, ?)"
+SQL_DEC_STOCK = "UPDATE products SET quantity = quantity - ? WHERE id = ?"
+# Whole-cart decrement in one statement, bound like SQL_CHECK_STOCK. A plain VALUES subquery
+# (column1 = id, column2 = qty) rather than a CTE, because sqlite3 reports no rowcount for WITH statements.
+SQL_DEC_STOCK_FROM_VALUES = """UPDATE products SET quantity = quantity - sold.column2
+                               FROM (VALUES {values}) AS sold WHERE products.id = sold.column1"""
+SQL_INSERT_RETURN = """INSERT INTO returns (product_id, quantity, return_price, reason, return_date, original_bill_identifier) 
+                       VALUES (?, ?, ?, ?, ?, ?)"""
+SQL_INC_STOCK = "UPDATE products SET quantity = quantity + ? WHERE id = ?"
+
 @app.route('/billing', methods=['GET', 'POST'])
 def billing():
     if 'user' not in session: flash("Please log in.", "warning"); return redirect(url_for('login'))
     db = get_db()
     if db is None: flash("Database connection unavailable for billing.", "danger"); return render_template('billing.html', cart=[], total=0, products=[], discounts=[], applied_discount_details=None, current_discount_amount_for_display=0.0, total_before_discount=0.0, win32print_available=(win32print is not None))
-    if 'cart' not in session: session['cart'] = []
-    
     discounts_list = get_all_discounts() # Returns list of (id, name, type, value)
     applied_discount_id = session.get('applied_bill_discount_id') 
     applied_discount_details = None
     current_discount_amount_for_display = 0.0
     
-    cart_items_for_display = session.get('cart', []) 
-    total_before_discount_for_display = sum(item['price'] * item['qty'] for item in cart_items_for_display) 
+    _flash_finished_print_jobs()
+    cart_items_for_display = list(_get_cart().values()) 
+    total_before_discount_for_display = _cart_total() 
 
     if applied_discount_id:
         disc_info_tuple = get_discount(int(applied_discount_id)) # Returns (id, name, type, value)
@@ -753,11 +1042,11 @@ def billing():
                     except (ValueError, TypeError): flash("Invalid product selection.", "danger")
 
                 if product_to_add:
-                    cart_session = session.get('cart', []) 
-                    item_found = next((item for item in cart_session if item['id'] == product_to_add['id']), None)
+                    cart_session = _get_cart() 
+                    item_found = cart_session.get(product_to_add['id'])
                     if item_found: item_found['qty'] += 1
-                    else: cart_session.append({'id': product_to_add['id'], 'barcode': product_to_add['barcode'], 'name': product_to_add['name'], 'price': float(product_to_add['selling_price']), 'qty': 1})
-                    session['cart'] = cart_session; session.modified = True; flash(f"Added '{product_to_add['name']}'.", "success")
+                    else: cart_session[product_to_add['id']] = {'id': product_to_add['id'], 'barcode': product_to_add['barcode'], 'name': product_to_add['name'], 'price': float(product_to_add['selling_price']), 'qty': 1}
+                    _save_cart(cart_session); flash(f"Added '{product_to_add['name']}'.", "success")
                 return redirect(url_for('billing'))
 
             elif action == 'apply_discount':
@@ -778,7 +1067,7 @@ def billing():
                 return redirect(url_for('billing'))
 
             elif action == 'checkout_and_print':
-                cart_for_sale = session.get('cart', []) 
+                cart_for_sale = list(_get_cart().values()) 
                 if not cart_for_sale:
                     flash("Cart is empty. Cannot checkout.", "warning")
                     return redirect(url_for('billing'))
@@ -788,7 +1077,7 @@ def billing():
                     flash("Please select a payment method before checking out.", "warning")
                     return redirect(url_for('billing'))
                 
-                bill_total_gross = sum(item['price'] * item['qty'] for item in cart_for_sale)
+                bill_total_gross = _cart_total()
                 bill_discount_id_final = session.get('applied_bill_discount_id')
                 bill_discount_amount_final = 0.0
                 applied_discount_display_for_receipt = "" # For flash message string
@@ -809,8 +1098,6 @@ def billing():
                 
                 final_amount_payable = bill_total_gross - bill_discount_amount_final
                 sale_time = datetime.now()
-                next_bill_no_int = get_next_bill_number()
-                bill_identifier_for_db = str(next_bill_no_int) 
                 user_id = session.get('user_id')
 
                 receipt_items_data_for_print = []
@@ -821,51 +1108,65 @@ def billing():
                 
                 try:
                     cur = db.cursor()
-                    db.execute('BEGIN') 
-                    for i, item_processed in enumerate(cart_for_sale):
-                        cur.execute("SELECT quantity FROM products WHERE id = ?", (item_processed['id'],))
-                        stock = cur.fetchone()
-                        if not stock or stock['quantity'] < item_processed['qty']:
-                            db.rollback(); flash(f"Insufficient stock for '{item_processed['name']}'. Sale aborted.", "danger"); return redirect(url_for('billing'))
+                    # (id, qty) pairs for the whole cart, shared by the stock check and the decrement (the cart holds each product once)
+                    qty_needed = {item_processed['id']: item_processed['qty'] for item_processed in cart_for_sale}
+                    cart_values_sql = ",".join(["(?, ?)"] * len(qty_needed))
+                    cart_values_params = [value for pair in qty_needed.items() for value in pair]
+                    with db: # Commits the bill as one transaction, or rolls it all back if anything raises
+                        db.execute('BEGIN IMMEDIATE')
+                        bill_identifier_for_db = str(get_next_bill_number(db)) # Claimed inside the sale's transaction
                         
-                        current_item_bill_discount = bill_discount_amount_final if i == 0 else 0.0 
-                        cur.execute(
-                            """INSERT INTO sales (bill_identifier, product_id, quantity, sale_price, sale_date, user_id, discount_applied_to_bill, payment_method) 
-                               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-                            (bill_identifier_for_db, item_processed['id'], item_processed['qty'], item_processed['price'], 
-                             sale_time, user_id, current_item_bill_discount, payment_method_from_form)
-                        )
-                        cur.execute("UPDATE products SET quantity = quantity - ? WHERE id = ?", (item_processed['qty'], item_processed['id']))
-                    db.commit()
+                        # The whole bill discount is recorded on the first line only
+                        cur.executemany(SQL_INSERT_SALE, 
+                                        [(bill_identifier_for_db, item_processed['id'], item_processed['qty'], item_processed['price'], 
+                                          sale_time, user_id, bill_discount_amount_final if i == 0 else 0.0, payment_method_from_form)
+                                         for i, item_processed in enumerate(cart_for_sale)])
+                        cur.execute(SQL_INSERT_BILL, (bill_identifier_for_db, sale_time, bill_discount_amount_final))
+                        # products' CHECK(quantity >= 0) fails the decrement (IntegrityError) if any product
+                        # would go below zero; fewer rows updated than products means one no longer exists
+                        try:
+                            if SQLITE_SUPPORTS_UPDATE_FROM:
+                                cur.execute(SQL_DEC_STOCK_FROM_VALUES.format(values=cart_values_sql), cart_values_params)
+                            else:
+                                cur.executemany(SQL_DEC_STOCK, [(qty, product_id) for product_id, qty in qty_needed.items()])
+                            stock_ok = cur.rowcount == len(qty_needed)
+                        except sqlite3.IntegrityError: stock_ok = False
+                        if not stock_ok:
+                            db.rollback()
+                            cur.execute(SQL_CHECK_STOCK.format(values=cart_values_sql), cart_values_params); short_row = cur.fetchone()
+                            short_name = next((item['name'] for item in cart_for_sale if short_row and item['id'] == short_row['id']), 'an item')
+                            flash(f"Insufficient stock for '{short_name}'. Sale aborted.", "danger"); return redirect(url_for('billing'))
+                    clear_analytics_cache()
+                    _bump_catalog_version()
                     
                     sale_flash_msg = f"Sale completed! Bill No: {bill_identifier_for_db}. Total: ₹{final_amount_payable:.2f}. Payment: {payment_method_from_form}."
                     if bill_discount_amount_final > 0 and applied_discount_display_for_receipt:
                         sale_flash_msg += f" (Discount of {applied_discount_display_for_receipt} [Actual Value: ₹{bill_discount_amount_final:.2f}] applied)."
                     flash(sale_flash_msg, "success")
 
-                    print_success_flag = False; print_status_message = "Printing skipped or printer not available."
                     if win32print: 
+                        # Spooler I/O happens on the printer thread; the outcome is flashed on a later /billing load
                         store_name = "Z Toys And Gifts"; insta_id = "ztoysandgifts"; contact = "7708159325"; address = "MS Road, Parvathipuram, Nagercoil-629003"
-                        print_success_flag, print_status_message = print_thermal_receipt(
+                        _queue_receipt_for_printing(bill_identifier_for_db, build_receipt_bytes(
                             store_name, insta_id, contact, address, receipt_items_data_for_print, 
                             final_amount_payable, bill_discount_amount_final, bill_id=bill_identifier_for_db,
                             payment_method=payment_method_from_form
-                        )
+                        ))
+                        session['pending_print_bills'] = (session.get('pending_print_bills', []) + [bill_identifier_for_db])[-PRINT_STATUS_MAXSIZE:]
+                        flash(f"Receipt for Bill No: {bill_identifier_for_db} sent to the printer.", "info")
+                    else: flash(f"Receipt printing for Bill No: {bill_identifier_for_db} status: Printing skipped or printer not available.", "warning")
                     
-                    if print_success_flag: flash(f"Receipt for Bill No: {bill_identifier_for_db} printed successfully.", "info")
-                    else: flash(f"Receipt printing for Bill No: {bill_identifier_for_db} status: {print_status_message}", "warning")
-                    
-                    session['cart'] = []; 
+                    _save_cart({})
                     if 'applied_bill_discount_id' in session: del session['applied_bill_discount_id']
                     session.modified = True
                     return redirect(url_for('billing', last_bill_id=bill_identifier_for_db)) 
 
                 except Exception as e:
-                    db.rollback(); flash(f"Error during checkout & print: {e}", "danger"); traceback.print_exc(); return redirect(url_for('billing'))
+                    flash(f"Error during checkout & print: {e}", "danger"); app.logger.exception("Error in billing"); return redirect(url_for('billing'))
         except Exception as e:
-            flash(f"Processing error in billing: {e}", "danger"); traceback.print_exc(); return redirect(url_for('billing'))
+            flash(f"Processing error in billing: {e}", "danger"); app.logger.exception("Error in billing"); return redirect(url_for('billing'))
     
-    cur = db.cursor(); cur.execute("SELECT id, name, selling_price FROM products WHERE quantity > 0 ORDER BY name COLLATE NOCASE"); available_products = cur.fetchall()
+    available_products = _load_billing_products()
     last_bill_id_for_print_option = request.args.get('last_bill_id')
 
     return render_template('billing.html', 
@@ -881,48 +1182,36 @@ def billing():
 @app.route('/increase-cart-item/<int:product_id>', methods=['POST'])
 def increase_cart_item(product_id):
     if 'user' not in session: flash("Please log in.", "warning"); return redirect(url_for('login'))
-    cart = session.get('cart', [])
-    found = False; db = get_db()
+    cart = _get_cart(); item = cart.get(product_id)
+    if item is None: flash("Item not found in cart.", "warning"); return redirect(url_for('billing'))
+    db = get_db()
     if db is None: flash("Database unavailable.", "danger"); return redirect(url_for('billing'))
-    cur = db.cursor()
-    for item in cart:
-        if item.get('id') == product_id:
-            item_name = item.get('name', 'Item')
-            try:
-                cur.execute("SELECT quantity FROM products WHERE id = ?", (product_id,)); stock_row = cur.fetchone()
-                if stock_row and stock_row['quantity'] > item['qty']: item['qty'] += 1; found = True; flash(f"Increased quantity for '{item_name}'.", "info")
-                elif stock_row: flash(f"No more '{item_name}', stock ({stock_row['quantity']} available).", "warning")
-                else: flash(f"Product ID {product_id} not found in database.", "warning")
-            except Exception as e: flash(f"Error checking stock: {e}", "danger"); traceback.print_exc()
-            break
-    if not found and any(item.get('id') == product_id for item in cart): pass 
-    elif not found: flash("Item not found in cart.", "warning")
-    session['cart'] = cart; session.modified = True
+    item_name = item.get('name', 'Item')
+    try:
+        cur = db.cursor(); cur.execute("SELECT quantity FROM products WHERE id = ?", (product_id,)); stock_row = cur.fetchone()
+        if stock_row and stock_row['quantity'] > item['qty']: item['qty'] += 1; flash(f"Increased quantity for '{item_name}'.", "info")
+        elif stock_row: flash(f"No more '{item_name}', stock ({stock_row['quantity']} available).", "warning")
+        else: flash(f"Product ID {product_id} not found in database.", "warning")
+    except Exception as e: flash(f"Error checking stock: {e}", "danger"); app.logger.exception("Error in increase_cart_item")
+    _save_cart(cart)
     return redirect(url_for('billing'))
 
 @app.route('/decrease-cart-item/<int:product_id>', methods=['POST'])
 def decrease_cart_item(product_id):
     if 'user' not in session: flash("Please log in.", "warning"); return redirect(url_for('login'))
-    cart = session.get('cart', []); item_to_remove_idx = -1; item_name = "Item"; found = False
-    for i, item in enumerate(cart):
-        if item.get('id') == product_id:
-            item_name = item.get('name', 'Item'); item['qty'] -= 1
-            if item['qty'] <= 0: item_to_remove_idx = i
-            found = True; break
-    if item_to_remove_idx != -1: del cart[item_to_remove_idx]; flash(f"Removed '{item_name}' from cart.", "info")
-    elif found: flash(f"Decreased quantity for '{item_name}'.", "info")
-    if not found: flash("Item not found in cart.", "warning")
-    session['cart'] = cart; session.modified = True
+    cart = _get_cart(); item = cart.get(product_id)
+    if item is None: flash("Item not found in cart.", "warning"); return redirect(url_for('billing'))
+    item_name = item.get('name', 'Item'); item['qty'] -= 1
+    if item['qty'] <= 0: del cart[product_id]; flash(f"Removed '{item_name}' from cart.", "info")
+    else: flash(f"Decreased quantity for '{item_name}'.", "info")
+    _save_cart(cart)
     return redirect(url_for('billing'))
 
 @app.route('/remove-cart-item/<int:product_id>', methods=['POST'])
 def remove_cart_item(product_id):
     if 'user' not in session: flash("Please log in.", "warning"); return redirect(url_for('login'))
-    cart = session.get('cart', []); original_length = len(cart); item_name = "Item"
-    for item_lookup in cart:
-        if item_lookup.get('id') == product_id: item_name = item_lookup.get('name', 'Item'); break
-    cart = [item for item in cart if item.get('id') != product_id]
-    if len(cart) < original_length: session['cart'] = cart; session.modified = True; flash(f"Removed '{item_name}' from cart.", "success")
+    cart = _get_cart(); item = cart.pop(product_id, None)
+    if item is not None: _save_cart(cart); flash(f"Removed '{item.get('name', 'Item')}' from cart.", "success")
     else: flash("Item not found in cart to remove.", "warning")
     return redirect(url_for('billing'))
 
@@ -940,7 +1229,7 @@ def return_order():
         products_list = cur.fetchall()
     except sqlite3.Error as e: 
         flash(f"Could not load products for return: {e}", "danger")
-        traceback.print_exc()
+        app.logger.exception("Error in return_order")
         products_list = []
 
     if request.method == 'POST':
@@ -977,24 +1266,21 @@ def return_order():
             for error in errors: flash(error, 'danger')
         else:
             try:
-                db.execute('BEGIN') 
-                cur.execute(
-                    """INSERT INTO returns (product_id, quantity, return_price, reason, return_date, original_bill_identifier) 
-                       VALUES (?, ?, ?, ?, ?, ?)""",
-                    (product_id, quantity, return_price, reason or None, datetime.now(), original_bill_identifier or None)
-                )
-                cur.execute("UPDATE products SET quantity = quantity + ? WHERE id = ?", (quantity, product_id))
-                db.commit()
+                with db: # Return row and restock commit together or not at all
+                    db.execute('BEGIN IMMEDIATE') 
+                    cur.execute(SQL_INSERT_RETURN, 
+                                (product_id, quantity, return_price, reason or None, datetime.now(), original_bill_identifier or None))
+                    cur.execute(SQL_INC_STOCK, (quantity, product_id))
+                clear_analytics_cache()
+                _bump_catalog_version()
                 flash(f"Return of {quantity} x '{product_data_for_flash['name'] if product_data_for_flash else 'Product'}' processed. Stock updated.", 'success')
                 return redirect(url_for('return_order')) 
             except sqlite3.Error as e: 
-                db.rollback()
                 flash(f"Database error processing return: {e}", 'danger')
-                traceback.print_exc()
+                app.logger.exception("Error in return_order")
             except Exception as e: 
-                db.rollback() 
                 flash(f"An unexpected error occurred during return processing: {e}", 'danger')
-                traceback.print_exc()
+                app.logger.exception("Error in return_order")
                 
     return render_template('return_order.html', products=products_list)
 
@@ -1006,7 +1292,7 @@ def product_analytics_page():
     if db is None: flash("Database connection unavailable.", "danger"); return render_template('product_analytics.html', products_summary=[])
     products_summary = []
     try: products_summary = get_sales_analytics(db, 'product_summary')
-    except Exception as e: flash(f"Error fetching product analytics data: {e}", "danger"); traceback.print_exc(); products_summary = []
+    except Exception as e: flash(f"Error fetching product analytics data: {e}", "danger"); app.logger.exception("Error in product_analytics_page"); products_summary = []
     return render_template('product_analytics.html', products_summary=products_summary)
 
 @app.route('/export-product-analytics')
@@ -1016,82 +1302,89 @@ def export_product_analytics():
     if db is None: flash("Database connection unavailable for export.", "danger"); return redirect(url_for('product_analytics_page'))
     try:
         products_summary = get_sales_analytics(db, 'product_summary')
-        wb = openpyxl.Workbook(); ws = wb.active; ws.title = "Product Sales Analytics"
         headers = ["ID", "Product Name", "Barcode", "Category", "Cost Price", "Selling Price", "Current Stock", "Gross Units Sold", "Units Returned", "Net Units Sold", "Total Revenue (Gross)", "Est. Profit (Gross)"]
-        ws.append(headers)
-        for product in products_summary:
-            ws.append([ product['id'], product['name'], product['barcode'], product['category_name'], product['cost_price'], product['selling_price'], product['current_stock'],
-                        product['total_units_sold_gross'], product['total_units_returned'], product['net_units_sold'], product['total_revenue_generated'], product['profit_generated_gross'] ])
-        for cell in ws[1]: cell.font = Font(bold=True)
-        for col_idx, column_cells in enumerate(ws.columns):
-            max_length = 0; column_letter = get_column_letter(col_idx + 1)
-            for cell in column_cells:
-                try:
-                    if len(str(cell.value)) > max_length: max_length = len(str(cell.value))
-                except: pass
-            adjusted_width = (max_length + 2) if max_length < 50 else 50 
-            ws.column_dimensions[column_letter].width = adjusted_width
-        excel_buffer = BytesIO(); wb.save(excel_buffer); excel_buffer.seek(0)
-        return send_file(excel_buffer, as_attachment=True, download_name='product_sales_analytics.xlsx', mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-    except Exception as e: flash(f"Error exporting data: {e}", "danger"); traceback.print_exc(); return redirect(url_for('product_analytics_page'))
+        rows = [[ product['id'], product['name'], product['barcode'], product['category_name'], product['cost_price'], product['selling_price'], product['current_stock'],
+                  product['total_units_sold_gross'], product['total_units_returned'], product['net_units_sold'], product['total_revenue_generated'], product['profit_generated_gross'] ]
+                for product in products_summary]
+        # Widths come from one pass over the values, since a write-only sheet needs them before the first append
+        max_lengths = [len(header) for header in headers]
+        for row in rows:
+            for col_idx, value in enumerate(row):
+                max_lengths[col_idx] = max(max_lengths[col_idx], len(str(value)))
+        wb = _new_export_workbook(); ws = wb.create_sheet(title="Product Sales Analytics")
+        for col_idx, max_length in enumerate(max_lengths):
+            ws.column_dimensions[get_column_letter(col_idx + 1)].width = (max_length + 2) if max_length < 50 else 50
+        ws.append([_bold_cell(ws, header) for header in headers])
+        for row in rows: ws.append(row)
+        return _send_workbook(wb, 'product_sales_analytics.xlsx')
+    except Exception as e: flash(f"Error exporting data: {e}", "danger"); app.logger.exception("Error in export_product_analytics"); return redirect(url_for('product_analytics_page'))
 
 # --- Bill History Route ---
+def _parse_db_timestamp(value):
+    """Parses a stored TIMESTAMP ('YYYY-MM-DD HH:MM:SS[.ffffff]') in one C-level call; None if unparseable."""
+    if not value: return None
+    try: return datetime.fromisoformat(str(value))
+    except ValueError: return None
+
+SQL_BILL_SUMMARIES = """
+    SELECT s.bill_identifier, MAX(s.sale_date) as sale_date, SUM(s.quantity * s.sale_price) as bill_total_gross,
+           MAX(s.discount_applied_to_bill) as discount_on_bill, MAX(s.payment_method) as payment_method,
+           MAX(u.username) as cashier_name
+    FROM sales s JOIN products p ON s.product_id = p.id LEFT JOIN users u ON s.user_id = u.id
+    GROUP BY s.bill_identifier
+    ORDER BY s.bill_identifier = '' OR s.bill_identifier GLOB '*[^0-9]*', CAST(s.bill_identifier AS INTEGER) DESC
+    LIMIT ? OFFSET ?"""
+# Returned line as the template sees it: the returns query's columns after original_bill_identifier,
+# plus the formatted date. Jinja reads fields as ret.name or ret['name'] alike.
+BillReturn = namedtuple('BillReturn', 'product_id product_name returned_quantity return_price return_date reason return_date_formatted')
+BILL_HISTORY_DEFAULT_PAGE_SIZE = 50
+BILL_HISTORY_MAX_PAGE_SIZE = 200
+
 @app.route('/bill-history')
 def bill_history():
     if 'user' not in session: flash("Please log in.", "warning"); return redirect(url_for('login'))
     db = get_db()
-    if db is None: flash("Database connection unavailable.", "danger"); return render_template('bill_history.html', bills_list=[])
-    bills_data = {}
+    if db is None: flash("Database connection unavailable.", "danger"); return render_template('bill_history.html', bills_list=[], page=1, page_size=BILL_HISTORY_DEFAULT_PAGE_SIZE, has_next_page=False)
+    page = max(request.args.get('page', 1, type=int), 1)
+    page_size = min(max(request.args.get('size', BILL_HISTORY_DEFAULT_PAGE_SIZE, type=int), 1), BILL_HISTORY_MAX_PAGE_SIZE)
+    bills_data = {}; has_next_page = False
     try:
         cur = db.cursor()
-        cur.execute("""
-            SELECT s.bill_identifier, s.sale_date, s.quantity, s.sale_price, s.discount_applied_to_bill, s.payment_method,
-                   p.name as product_name, u.username as cashier_name
-            FROM sales s JOIN products p ON s.product_id = p.id LEFT JOIN users u ON s.user_id = u.id
-            ORDER BY s.sale_date DESC, s.bill_identifier DESC, s.id ASC """)
-        all_sale_items = cur.fetchall()
-        for item_row in all_sale_items:
-            bill_id = item_row['bill_identifier']
-            if bill_id not in bills_data:
-                sale_date_obj = None
-                if item_row['sale_date']:
-                    try: sale_date_obj = datetime.strptime(str(item_row['sale_date']), '%Y-%m-%d %H:%M:%S.%f')
-                    except ValueError:
-                        try: sale_date_obj = datetime.strptime(str(item_row['sale_date']), '%Y-%m-%d %H:%M:%S')
-                        except ValueError: pass
-                formatted_date = sale_date_obj.strftime('%d %b %Y, %I:%M %p') if sale_date_obj else 'N/A'
-                bills_data[bill_id] = {
-                    'bill_identifier': bill_id, 'sale_date_raw': sale_date_obj, 'sale_date_formatted': formatted_date,
-                    'cashier_name': item_row['cashier_name'] or 'N/A', 'bill_products': [],
-                    'bill_total_gross': 0.0, 'discount_on_bill': float(item_row['discount_applied_to_bill'] or 0.0),
-                    'payment_method': item_row['payment_method'] or 'N/A', 'bill_final_amount': 0.0, 'returns': []
-                }
-            item_subtotal = item_row['quantity'] * item_row['sale_price']
-            bills_data[bill_id]['bill_products'].append({'product_name': item_row['product_name'], 'quantity': item_row['quantity'], 'sale_price': item_row['sale_price'], 'subtotal': item_subtotal})
-            bills_data[bill_id]['bill_total_gross'] += item_subtotal
-        for bill_id_key in list(bills_data.keys()): 
-            bill = bills_data[bill_id_key]
-            bill['bill_final_amount'] = bill['bill_total_gross'] - bill['discount_on_bill']
-            cur.execute("SELECT r.product_id, p.name as product_name, r.quantity as returned_quantity, r.return_price, r.return_date, r.reason FROM returns r JOIN products p ON r.product_id = p.id WHERE r.original_bill_identifier = ? ORDER BY r.return_date DESC", (bill_id_key,))
-            bill_returns = cur.fetchall()
-            if bill_returns:
-                bill['returns'] = []
-                for ret_row in bill_returns:
-                    ret_date_obj = None
-                    if ret_row['return_date']:
-                        try: ret_date_obj = datetime.strptime(str(ret_row['return_date']), '%Y-%m-%d %H:%M:%S.%f')
-                        except ValueError:
-                            try: ret_date_obj = datetime.strptime(str(ret_row['return_date']), '%Y-%m-%d %H:%M:%S')
-                            except ValueError: pass
-                    return_item_dict = dict(ret_row); return_item_dict['return_date_formatted'] = ret_date_obj.strftime('%d %b %Y, %I:%M %p') if ret_date_obj else 'N/A'
-                    bill['returns'].append(return_item_dict)
-    except sqlite3.Error as e: flash(f"Error fetching bill history: {e}", "danger"); traceback.print_exc(); bills_data = {}
-    except Exception as e: flash(f"An unexpected error occurred in bill history: {e}", "danger"); traceback.print_exc(); bills_data = {}
-    def sort_key_bill_history(b):
-        try: return int(b['bill_identifier']) 
-        except ValueError: return float('-inf') 
-    sorted_bills_list = sorted(bills_data.values(), key=sort_key_bill_history, reverse=True)
-    return render_template('bill_history.html', bills_list=sorted_bills_list)
+        # Totals are aggregated by SQLite; numeric bill numbers sort newest first, anything
+        # non-numeric goes last. The discount is stored on one line per bill, hence MAX.
+        # One extra row tells whether a next page exists; items and returns are then fetched only for this page
+        cur.execute(SQL_BILL_SUMMARIES, (page_size + 1, (page - 1) * page_size))
+        bill_rows = cur.fetchall()
+        has_next_page = len(bill_rows) > page_size
+        for bill_row in bill_rows[:page_size]:
+            sale_date_obj = _parse_db_timestamp(bill_row['sale_date'])
+            bill_total_gross = bill_row['bill_total_gross'] or 0.0
+            discount_on_bill = float(bill_row['discount_on_bill'] or 0.0)
+            bills_data[bill_row['bill_identifier']] = {
+                'bill_identifier': bill_row['bill_identifier'], 'sale_date_raw': sale_date_obj,
+                'sale_date_formatted': sale_date_obj.strftime('%d %b %Y, %I:%M %p') if sale_date_obj else 'N/A',
+                'cashier_name': bill_row['cashier_name'] or 'N/A', 'bill_products': [],
+                'bill_total_gross': bill_total_gross, 'discount_on_bill': discount_on_bill,
+                'payment_method': bill_row['payment_method'] or 'N/A', 'bill_final_amount': bill_total_gross - discount_on_bill, 'returns': []
+            }
+        page_bill_ids = list(bills_data)
+        placeholders = ",".join("?" * len(page_bill_ids))
+        cur.execute(f"""SELECT s.bill_identifier, s.quantity, s.sale_price, p.name as product_name
+                        FROM sales s JOIN products p ON s.product_id = p.id
+                        WHERE s.bill_identifier IN ({placeholders}) ORDER BY s.id""", page_bill_ids)
+        for item_row in cur.fetchall():
+            bills_data[item_row['bill_identifier']]['bill_products'].append({'product_name': item_row['product_name'], 'quantity': item_row['quantity'], 'sale_price': item_row['sale_price'], 'subtotal': item_row['quantity'] * item_row['sale_price']})
+        cur.execute(f"""SELECT r.original_bill_identifier, r.product_id, p.name as product_name, r.quantity as returned_quantity, r.return_price, r.return_date, r.reason
+                        FROM returns r JOIN products p ON r.product_id = p.id
+                        WHERE r.original_bill_identifier IN ({placeholders}) ORDER BY r.return_date DESC""", page_bill_ids)
+        for ret_row in cur.fetchall():
+            bill = bills_data.get(ret_row['original_bill_identifier'])
+            if bill is None: continue
+            ret_date_obj = _parse_db_timestamp(ret_row['return_date'])
+            bill['returns'].append(BillReturn(*ret_row[1:], ret_date_obj.strftime('%d %b %Y, %I:%M %p') if ret_date_obj else 'N/A'))
+    except sqlite3.Error as e: flash(f"Error fetching bill history: {e}", "danger"); app.logger.exception("Error in bill_history"); bills_data = {}
+    except Exception as e: flash(f"An unexpected error occurred in bill history: {e}", "danger"); app.logger.exception("Error in bill_history"); bills_data = {}
+    return render_template('bill_history.html', bills_list=list(bills_data.values()), page=page, page_size=page_size, has_next_page=has_next_page)
 
 # --- Error Handlers ---
 @app.errorhandler(404)
@@ -1099,11 +1392,11 @@ def page_not_found(e): return render_template('404.html'), 404
 
 @app.errorhandler(500)
 def internal_server_error(e):
-    print(f"Internal Server Error 500: {e}"); traceback.print_exc()
+    app.logger.error(f"Internal Server Error 500: {e}", exc_info=getattr(e, 'original_exception', None) or e)
     db = getattr(g, 'sqlite_db', None)
     if db is not None:
         try: db.rollback(); print("DB Rolled back due to 500 error.")
-        except Exception as rollback_e: print(f"Error during DB rollback on 500 error: {rollback_e}"); traceback.print_exc()
+        except Exception as rollback_e: app.logger.exception(f"Error during DB rollback on 500 error: {rollback_e}")
     flash("An internal server error occurred. Please try again later or contact support.", "danger")
     if 'user' in session: return redirect(url_for('dashboard'))
     return redirect(url_for('login'))
@@ -1170,141 +1463,207 @@ def print_receipt_ajax():
     return jsonify({"success": success, "message": message})
 
 
-def print_thermal_receipt(store_name, insta_id, contact, address, items, total,
-                          discount_amount=0, bill_id=None, payment_method=None,
-                          printer_name=None):
-    if not win32print:
-        return False, "Printing not supported or win32print missing."
-
-    # Choose default printer if none provided
-    if printer_name is None:
-        try:
-            printer_name = win32print.GetDefaultPrinter()
-        except Exception as e:
-            traceback.print_exc()
-            return False, f"Error getting default printer: {e}"
-
-    try:
-        h_printer = win32print.OpenPrinter(printer_name)
-    except Exception as e:
-        traceback.print_exc()
-        return False, f"Could not open printer: {e}"
-
-    # ESC/POS commands
-    ESC = b'\x1b'
-    GS = b'\x1d'
-    INIT = ESC + b'@'
-    BOLD_ON = ESC + b'E' + b'\x01'
-    BOLD_OFF = ESC + b'E' + b'\x00'
-    SIZE_BIG = GS + b'!' + b'\x11'
-    SIZE_NORMAL = GS + b'!' + b'\x00'
-    ALIGN_CENTER = ESC + b'a' + b'\x01'
-    ALIGN_LEFT = ESC + b'a' + b'\x00'
-    ALIGN_RIGHT = ESC + b'a' + b'\x02'
-    FEED_4 = ESC + b'd' + b'\x04'
-    CUT = GS + b'V' + b'\x00'
-    
-    # Start building the receipt
-    rc = bytearray()
-    rc += INIT
+# ESC/POS commands and the fixed parts of every receipt, built once at import
+ESC = b'\x1b'
+GS = b'\x1d'
+RECEIPT_INIT = ESC + b'@'
+BOLD_ON = ESC + b'E' + b'\x01'
+BOLD_OFF = ESC + b'E' + b'\x00'
+SIZE_BIG = GS + b'!' + b'\x11'
+SIZE_NORMAL = GS + b'!' + b'\x00'
+ALIGN_CENTER = ESC + b'a' + b'\x01'
+ALIGN_LEFT = ESC + b'a' + b'\x00'
+ALIGN_RIGHT = ESC + b'a' + b'\x02'
+FEED_4 = ESC + b'd' + b'\x04'
+CUT = GS + b'V' + b'\x00'
+RECEIPT_TITLE_ON = ALIGN_CENTER + SIZE_BIG + BOLD_ON # Store name: centered, double size, bold
+RECEIPT_TITLE_OFF = BOLD_OFF + SIZE_NORMAL
+RECEIPT_SEPARATOR = b'-' * 48 + b'\n'
+RECEIPT_ITEMS_HEADER = (RECEIPT_SEPARATOR
+                        + f"{'Item':<22} {'Qty':>3} {'Price':>8} {'Total':>10}\n".encode('utf-8')
+                        + RECEIPT_SEPARATOR)
+# printf-style line formats: one C-level formatting call per line instead of per-field f-string specs
+RECEIPT_ITEM_FMT = "%-22s %3d %8.2f %10.2f\n"
+RECEIPT_TOTAL_FMT = "%30s %12.2f\n"
+RECEIPT_LABEL_FMT = "%30s %12s\n"
+# Same layout as strftime('%d/%m/%Y %I:%M %p'), formatted straight into bytes without the locale path
+RECEIPT_DATE_FMT = ALIGN_CENTER + b"%02d/%02d/%04d %02d:%02d %s\n"
+# The totals block is formatted as one string and encoded once; its control codes are plain ASCII
+RECEIPT_DISCOUNT_FMT = RECEIPT_TOTAL_FMT + RECEIPT_TOTAL_FMT + RECEIPT_SEPARATOR.decode('ascii')
+RECEIPT_GRAND_TOTAL_FMT = BOLD_ON.decode('ascii') + RECEIPT_TOTAL_FMT + BOLD_OFF.decode('ascii')
+RECEIPT_FOOTER = b'\n' + ALIGN_CENTER + b"Thank you for shopping!\n" + b"Have a great day!\n" + FEED_4 + CUT
+
+# The default printer name and one open handle per printer are kept between receipts, so a
+# print doesn't pay for GetDefaultPrinter/OpenPrinter each time. A handle is taken out of the
+# cache while in use, so two threads never share one.
+_printer_cache_lock = threading.Lock()
+_default_printer_cache = None
+_printer_handle_cache = {}
+# /available-printers is polled by the page; EnumPrinters is reused for this many seconds
+PRINTER_LIST_TTL_SECONDS = 10
+_printer_list_cache = None # (monotonic time, printers, default printer)
+
+def _get_default_printer():
+    global _default_printer_cache
+    with _printer_cache_lock:
+        if _default_printer_cache is None:
+            _default_printer_cache = win32print.GetDefaultPrinter()
+        return _default_printer_cache
+
+def _forget_default_printer():
+    global _default_printer_cache
+    with _printer_cache_lock: _default_printer_cache = None
+
+def _take_printer_handle(printer_name):
+    """Returns (handle, was_cached), opening the printer if no idle handle is cached."""
+    with _printer_cache_lock:
+        h_printer = _printer_handle_cache.pop(printer_name, None)
+    if h_printer is not None:
+        return h_printer, True
+    return win32print.OpenPrinter(printer_name), False
+
+def _return_printer_handle(printer_name, h_printer):
+    with _printer_cache_lock:
+        if printer_name not in _printer_handle_cache:
+            _printer_handle_cache[printer_name] = h_printer; return
+    win32print.ClosePrinter(h_printer) # Another thread already cached one for this printer
+
+@functools.lru_cache(maxsize=1024)
+def _receipt_display_name(name):
+    """Item name as printed in the 22-character receipt column; product names repeat across receipts."""
+    return (name[:20] + '..') if len(name) > 22 else name
+
+def _encode_receipt_text(text):
+    """Receipt text to bytes; most lines are pure ASCII, which skips the UTF-8 codec's error handling."""
+    return text.encode('ascii') if text.isascii() else text.encode('utf-8', 'replace')
+
+@functools.lru_cache(maxsize=8)
+def _receipt_store_blocks(store_name, insta_id, contact, address):
+    """
+    Encoded (title, contact/address) blocks for a store. They only change when the store
+    details do, so each receipt reuses them; the date and bill number go between the two.
+    """
+    title = RECEIPT_TITLE_ON + _encode_receipt_text(f"{store_name}\n") + RECEIPT_TITLE_OFF
+    details = ALIGN_LEFT + _encode_receipt_text(f"@{insta_id}\nContact: {contact}\n{address}\n\n")
+    return title, details
+
+def build_receipt_bytes(store_name, insta_id, contact, address, items, total,
+                        discount_amount=0, bill_id=None, payment_method=None):
+    """The complete ESC/POS payload for one receipt, from printer init to paper cut."""
+    # Fixed pieces are module-level bytes; each dynamic line is encoded once into `parts`, and the
+    # payload is joined once, before the printer is opened so a formatting error can't leak the handle
+    title_block, details_block = _receipt_store_blocks(store_name, insta_id, contact, address)
 
     # Header: store name (centered)
-    rc += ALIGN_CENTER + SIZE_BIG + BOLD_ON
-    rc += store_name.encode('utf-8', 'replace') + b'\n'
-    rc += BOLD_OFF + SIZE_NORMAL
+    parts = [RECEIPT_INIT, title_block]
 
     # Date/time and bill ID (centered)
-    now_str = datetime.now().strftime('%d/%m/%Y %I:%M %p')
-    rc += ALIGN_CENTER + now_str.encode('utf-8', 'replace') + b'\n'
-    
+    now = datetime.now()
+    parts.append(RECEIPT_DATE_FMT % (now.day, now.month, now.year, now.hour % 12 or 12, now.minute,
+                                     b'AM' if now.hour < 12 else b'PM'))
     if bill_id:
-        rc += ALIGN_CENTER + f"Bill No: {bill_id}".encode('utf-8', 'replace') + b'\n'
+        parts += [ALIGN_CENTER, _encode_receipt_text(f"Bill No: {bill_id}\n")]
 
     # Contact info & address (left aligned)
-    rc += ALIGN_LEFT
-    rc += f"@{insta_id}\n".encode('utf-8', 'replace')
-    rc += f"Contact: {contact}\n".encode('utf-8', 'replace')
-    rc += address.encode('utf-8', 'replace') + b'\n\n'
-
-    # Items section
-    # Separator line
-    separator = b'-' * 48 + b'\n'
-    rc += separator
-
-    # Column headers
-    header_line = f"{'Item':<22} {'Qty':>3} {'Price':>8} {'Total':>10}\n"
-    rc += header_line.encode('utf-8', 'replace')
-    rc += separator
-
-    # Item lines
-    for name, qty, price_per_item, subtotal in items:
-        # Truncate name if too long
-        display_name = (name[:20] + '..') if len(name) > 22 else name
-        
-        # Format the line with proper spacing
-        item_line = f"{display_name:<22} {qty:>3} {price_per_item:>8.2f} {subtotal:>10.2f}\n"
-        rc += item_line.encode('utf-8', 'replace')
+    parts.append(details_block)
 
-    rc += separator
+    # Items section: separator, column headers, one line per item
+    parts.append(RECEIPT_ITEMS_HEADER)
+    for name, qty, price_per_item, subtotal in items:
+        parts.append(_encode_receipt_text(RECEIPT_ITEM_FMT % (_receipt_display_name(name), qty, price_per_item, subtotal)))
+    parts.append(RECEIPT_SEPARATOR)
 
-    # Totals section (right aligned)
+    # Totals section (right aligned): subtotal/discount, final total (bold), payment method
+    totals_text = RECEIPT_GRAND_TOTAL_FMT % ('TOTAL:', total)
     if discount_amount > 0:
-        original_total = total + discount_amount
-        
-        # Original total line
-        total_line = f"{'Subtotal:':>30} {original_total:>12.2f}\n"
-        rc += total_line.encode('utf-8', 'replace')
-        
-        # Discount line
-        discount_line = f"{'Discount:':>30} {-discount_amount:>12.2f}\n"
-        rc += discount_line.encode('utf-8', 'replace')
-        
-        rc += separator
+        totals_text = RECEIPT_DISCOUNT_FMT % ('Subtotal:', total + discount_amount, 'Discount:', -discount_amount) + totals_text
+    if payment_method:
+        totals_text += RECEIPT_LABEL_FMT % ('Payment:', payment_method)
+    parts.append(_encode_receipt_text(totals_text))
 
-    # Final total (bold)
-    rc += BOLD_ON
-    final_total_line = f"{'TOTAL:':>30} {total:>12.2f}\n"
-    rc += final_total_line.encode('utf-8', 'replace')
-    rc += BOLD_OFF
+    # Footer, paper feed and cut
+    parts.append(RECEIPT_FOOTER)
+    return b''.join(parts)
 
-    # Payment method
-    if payment_method:
-        payment_line = f"{'Payment:':>30} {payment_method:>12}\n"
-        rc += payment_line.encode('utf-8', 'replace')
+def print_thermal_receipt(store_name, insta_id, contact, address, items, total,
+                          discount_amount=0, bill_id=None, payment_method=None,
+                          printer_name=None):
+    if not win32print:
+        return False, "Printing not supported or win32print missing."
+    receipt_bytes = build_receipt_bytes(store_name, insta_id, contact, address, items, total,
+                                        discount_amount=discount_amount, bill_id=bill_id, payment_method=payment_method)
+    return send_to_printer(receipt_bytes, printer_name)
 
-    # Footer
-    rc += b'\n'
-    rc += ALIGN_CENTER + b"Thank you for shopping!\n"
-    rc += b"Have a great day!\n"
-    
-    # Feed paper and cut
-    rc += FEED_4 + CUT
+def send_to_printer(receipt_bytes, printer_name=None):
+    """Writes a RAW payload (one or more receipts) to the printer as a single spool job."""
+    if not win32print:
+        return False, "Printing not supported or win32print missing."
 
-    # Send to printer
-    try:
-        win32print.StartDocPrinter(h_printer, 1, ("Receipt", None, "RAW"))
-        win32print.StartPagePrinter(h_printer)
-        win32print.WritePrinter(h_printer, bytes(rc))
-        win32print.EndPagePrinter(h_printer)
-        win32print.EndDocPrinter(h_printer)
-        win32print.ClosePrinter(h_printer)
-        return True, "Printed successfully"
-    except Exception as e:
-        traceback.print_exc()
+    # Choose default printer if none provided
+    if printer_name is None:
         try:
-            win32print.ClosePrinter(h_printer)
-        except:
-            pass
-        return False, str(e)
+            printer_name = _get_default_printer()
+        except Exception as e:
+            app.logger.exception("Error in print_thermal_receipt")
+            return False, f"Error getting default printer: {e}"
+
+    # Send to printer. A cached handle can go stale (printer restarted or reconnected), so one
+    # failure on a cached handle is retried with a freshly opened one.
+    for attempt in (1, 2):
+        try:
+            h_printer, was_cached = _take_printer_handle(printer_name)
+        except Exception as e:
+            app.logger.exception("Error in print_thermal_receipt")
+            _forget_default_printer()
+            return False, f"Could not open printer: {e}"
+        try:
+            win32print.StartDocPrinter(h_printer, 1, ("Receipt", None, "RAW"))
+            win32print.StartPagePrinter(h_printer)
+            win32print.WritePrinter(h_printer, receipt_bytes)
+            win32print.EndPagePrinter(h_printer)
+            win32print.EndDocPrinter(h_printer)
+        except Exception as e:
+            try:
+                win32print.ClosePrinter(h_printer)
+            except:
+                pass
+            if was_cached and attempt == 1: continue
+            app.logger.exception("Error in print_thermal_receipt")
+            return False, str(e)
+        _return_printer_handle(printer_name, h_printer)
+        return True, "Printed successfully"
+
+def _list_printers(refresh=False):
+    """(local printer names, default printer), enumerated at most once per PRINTER_LIST_TTL_SECONDS."""
+    global _printer_list_cache
+    with _printer_cache_lock:
+        cached = _printer_list_cache
+    if cached and not refresh and time.monotonic() - cached[0] < PRINTER_LIST_TTL_SECONDS:
+        return cached[1], cached[2]
+    printers_list = [p[2] for p in win32print.EnumPrinters(win32print.PRINTER_ENUM_LOCAL, None, 1)]
+    _forget_default_printer() # Listing printers also refreshes the cached default
+    default_printer = _get_default_printer()
+    with _printer_cache_lock:
+        _printer_list_cache = (time.monotonic(), printers_list, default_printer)
+    return printers_list, default_printer
+
 @app.route('/available-printers')
 def get_printers():
     if 'user' not in session: return jsonify({"success": False, "message": "Log in first"}), 401
     if not win32print: return jsonify({"success": False, "message": "Printing disabled."}), 500
     try:
-        printers_list = [p[2] for p in win32print.EnumPrinters(win32print.PRINTER_ENUM_LOCAL, None, 1)]
-        default_printer = win32print.GetDefaultPrinter()
+        printers_list, default_printer = _list_printers(refresh=request.args.get('refresh') == '1')
         return jsonify({"success": True, "printers": printers_list, "default": default_printer})
-    except Exception as e: traceback.print_exc(); return jsonify({"success": False, "message": f"Error fetching printers: {str(e)}"}), 500
+    except Exception as e: app.logger.exception("Error in get_printers"); return jsonify({"success": False, "message": f"Error fetching printers: {str(e)}"}), 500
+
+@app.route('/flush-print-queue', methods=['POST'])
+def flush_print_queue():
+    """Sends any batched receipts now and waits for the spool job (for testing/debugging printing)."""
+    if 'user' not in session: return jsonify({"success": False, "message": "Log in first"}), 401
+    try:
+        sent = _printer_executor.submit(_flush_print_batch).result()
+        return jsonify({"success": True, "receipts_sent": sent})
+    except Exception as e: app.logger.exception("Error in flush_print_queue"); return jsonify({"success": False, "message": f"Error flushing print queue: {str(e)}"}), 500
 
 #--Discounts--
 @app.route('/discounts')
@@ -1352,9 +1711,9 @@ def discount_new():
             # Return to the form, preserving user input
             return render_template('discount_new.html') # request.form is available in template context
 
-        # If no errors, proceed to create discount
+        # If no errors, proceed to create discount on this request's connection
         try:
-            create_discount(name, discount_type, value) # Updated model function
+            create_discount(name, discount_type, value, get_db())
             flash(f"Discount '{name}' ({discount_type.capitalize()}: {value}) created successfully.", "success")
             return redirect(url_for('discount_list'))
         except sqlite3.IntegrityError: # Handles UNIQUE constraint on name
@@ -1365,7 +1724,7 @@ def discount_new():
             db = get_db()
             if db: db.rollback()
             flash(f"Could not create discount: {e}", "danger")
-            traceback.print_exc()
+            app.logger.exception("Error in discount_new")
         # Fall through to render form again if DB error occurred after validation
         return render_template('discount_new.html')
 
@@ -1381,7 +1740,7 @@ if __name__ == '__main__':
             print(f"Created directory: {barcode_dir}")
         except OSError as e:
             print(f"Warning: Error creating barcode directory {barcode_dir}: {e}")
-            traceback.print_exc()
+            app.logger.exception("Error creating barcode directory")
             # This is not treated as a critical error, app can run without it if barcodes are not generated.
 
     # Database setup (moved outside app context as it's a one-time startup check)
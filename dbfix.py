@@ -18,12 +18,21 @@ def _get_persistent_data_base_path():
 
 DB_PATH = os.path.join(_get_persistent_data_base_path(), 'instance', 'toystore.db')
 
+# table name -> set of column names, filled by column_exists()
+_table_columns = {}
+
 def column_exists(cursor, table_name, column_name):
-    """Checks if a column exists in a table."""
-    cursor.execute(f"PRAGMA table_info({table_name})")
-    columns = [row[1] for row in cursor.fetchall()]
+    """Checks if a column exists in a table. Columns are read once per table and cached."""
+    columns = _table_columns.get(table_name)
+    if columns is None:
+        cursor.execute("SELECT name FROM pragma_table_info(?)", (table_name,))
+        columns = _table_columns[table_name] = {row[0] for row in cursor.fetchall()}
     return column_name in columns
 
+def forget_columns(table_name):
+    """Drops the cached column set for a table; call after altering it."""
+    _table_columns.pop(table_name, None)
+
 def migrate_discounts_table():
     """
     Migrates the discounts table to the new schema:
@@ -54,12 +63,14 @@ def migrate_discounts_table():
         if not column_exists(cur, 'discounts', 'discount_type'):
             print("Adding 'discount_type' column...")
             cur.execute("ALTER TABLE discounts ADD COLUMN discount_type TEXT")
+            forget_columns('discounts')
         else:
             print("'discount_type' column already exists.")
 
         if not column_exists(cur, 'discounts', 'value'):
             print("Adding 'value' column...")
             cur.execute("ALTER TABLE discounts ADD COLUMN value REAL")
+            forget_columns('discounts')
         else:
             print("'value' column already exists.")
 
@@ -118,6 +129,7 @@ def migrate_discounts_table():
             # We'll assume a modern SQLite version. If not, the more complex table recreation is needed.
             try:
                 cur.execute("ALTER TABLE discounts DROP COLUMN percent")
+                forget_columns('discounts')
                 print("'percent' column dropped successfully.")
             except sqlite3.OperationalError as e:
                 if "near \"DROP\": syntax error" in str(e) or "Cannot drop column" in str(e):
@@ -3,6 +3,29 @@
 import sqlite3
 import os
 import sys # Added for PyInstaller path handling
+import queue
+import functools
+import threading
+
+# Maximum number of idle connections kept around for reuse between requests
+POOL_SIZE = 8
+_connection_pool = queue.Queue(maxsize=POOL_SIZE)
+# Pooled connections move between request threads (one user at a time). That is only safe
+# when SQLite is built multi-threaded or serialized; a single-thread build closes them instead.
+_POOL_ACROSS_THREADS = sqlite3.threadsafety != 0
+
+# ':memory:' is mapped to a named shared-cache database so every connection sees the same
+# schema (the StaticPool idea); _memory_db_keeper holds it open for the life of the process.
+MEMORY_DB_URI = 'file:toystore_memdb?mode=memory&cache=shared'
+_database_path_override = None
+_memory_db_keeper = None
+
+# Set by init_db() once the products_fts trigram index is known to exist
+_products_fts_enabled = False
+# Bumped by create_discount() after its commit; get_all_discounts() caches per version, so a
+# read that raced the insert can only store its stale list under the old, never-read version
+_discounts_version = 0
+_discounts_version_lock = threading.Lock()
 
 # Helper to determine the base path for data storage (especially the database)
 def _get_persistent_data_base_path():
@@ -22,22 +45,98 @@ def _get_persistent_data_base_path():
         return os.path.abspath(".")
 
 
+def set_database_path(path):
+    """
+    Points connect_db() at `path` instead of instance/toystore.db (None restores the default).
+    Use ':memory:' for tests. Idle pooled connections to the previous database are closed.
+    """
+    global _database_path_override, _memory_db_keeper
+    _database_path_override = path
+    while True:
+        try:
+            _connection_pool.get_nowait().close()
+        except queue.Empty:
+            break
+    if path == ':memory:' and _memory_db_keeper is None:
+        _memory_db_keeper = connect_db()
+
+
 def connect_db():
     """Connect to SQLite database with improved settings to prevent locking."""
-    base_dir = _get_persistent_data_base_path()
-    db_path = os.path.join(base_dir, 'instance', 'toystore.db')
-    os.makedirs(os.path.dirname(db_path), exist_ok=True)
-    return sqlite3.connect(
+    if _database_path_override == ':memory:':
+        return sqlite3.connect(
+            MEMORY_DB_URI, uri=True,
+            check_same_thread=False,
+            timeout=30,
+            isolation_level=None
+        )
+    if _database_path_override:
+        db_path = _database_path_override
+    else:
+        base_dir = _get_persistent_data_base_path()
+        db_path = os.path.join(base_dir, 'instance', 'toystore.db')
+    if os.path.dirname(db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(
         db_path,
         check_same_thread=False,
         timeout=30,
         isolation_level=None # Autocommit mode; transactions managed explicitly
     )
+    # Per-connection setting; with WAL (set persistently by init_db) a commit appends to the
+    # log and defers the fsync to checkpoints instead of syncing the journal every time
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def _create_pooled_connection():
+    """Opens a long-lived connection tuned for reuse across requests."""
+    conn = connect_db()
+    conn.row_factory = sqlite3.Row
+    # Busy waits come from connect_db()'s timeout=30, which sets SQLite's busy handler
+    # journal_mode=WAL is stored in the database file by init_db(), so it isn't repeated here
+    if _database_path_override != ':memory:': # mmap doesn't apply to in-memory databases
+        conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536") # 64 MiB of page cache for the repeated analytics scans
+    return conn
+
+
+def acquire_connection():
+    """
+    Takes an idle connection from the pool, opening a new one if none is free.
+    Connections always come back with row_factory set to sqlite3.Row.
+    """
+    try:
+        return _connection_pool.get_nowait()
+    except queue.Empty:
+        return _create_pooled_connection()
+
+
+def release_connection(conn):
+    """
+    Returns a connection to the pool instead of closing it.
+    Any transaction left open by the caller is rolled back first so the next
+    user starts clean. Connections beyond POOL_SIZE are closed.
+    """
+    if conn is None:
+        return
+    if not _POOL_ACROSS_THREADS:
+        conn.close()
+        return
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        _connection_pool.put_nowait(conn)
+    except (queue.Full, sqlite3.Error):
+        conn.close()
 
 
 def init_db():
     """Initializes the database and creates tables if they don't exist."""
     conn = connect_db()
+    if _database_path_override != ':memory:':
+        conn.execute("PRAGMA journal_mode=WAL") # Persistent: stored in the database file
     conn.execute("PRAGMA foreign_keys = ON")
     cur = conn.cursor()
     conn.execute('BEGIN') # Start a transaction for all DDL
@@ -73,8 +172,14 @@ def init_db():
             FOREIGN KEY(category_id) REFERENCES categories(id) ON DELETE SET NULL
         )
         ''')
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_product_barcode ON products (barcode)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_product_name ON products (name)")
+        # barcode is UNIQUE, so sqlite_autoindex_products_1 already serves barcode lookups
+        cur.execute("DROP INDEX IF EXISTS idx_product_barcode")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_product_name ON products (name)") # name is declared COLLATE NOCASE
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_products_category_name ON products (category_id, name COLLATE NOCASE)")
+        _init_products_fts(cur)
+        # products.quantity's CHECK(quantity >= 0) already makes checkout's decrement fail with
+        # sqlite3.IntegrityError on insufficient stock; an earlier duplicate trigger is removed
+        cur.execute("DROP TRIGGER IF EXISTS products_stock_nonnegative")
 
         # Sales table - MODIFIED
         cur.execute('''
@@ -92,9 +197,18 @@ def init_db():
             FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE SET NULL
         )
         ''')
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_sales_sale_date ON sales (sale_date)")
+        # sale_date range scans are served by idx_sales_cover below, so neither the single-column
+        # index nor the old (sale_date, bill_identifier) one is kept
+        cur.execute("DROP INDEX IF EXISTS idx_sales_sale_date")
+        cur.execute("DROP INDEX IF EXISTS idx_sales_date_bill")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_sales_product_id ON sales (product_id)") # Per-product analytics joins
         cur.execute("CREATE INDEX IF NOT EXISTS idx_sales_bill_identifier ON sales (bill_identifier)")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_sales_payment_method ON sales (payment_method)") # Optional index
+        # Covers every column the date-range analytics read from sales (bill discounts come from the
+        # bills table), so those scans are answered from this index without visiting the sales rows.
+        # Its sale_date prefix also serves everything the narrower idx_sales_date_qty_price did
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_sales_cover ON sales (sale_date, product_id, bill_identifier, quantity, sale_price)")
+        cur.execute("DROP INDEX IF EXISTS idx_sales_date_qty_price")
 
         # Returns table
         cur.execute('''
@@ -111,10 +225,69 @@ def init_db():
             FOREIGN KEY(original_bill_identifier) REFERENCES sales(bill_identifier) ON DELETE SET NULL 
         )
         ''')
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_returns_return_date ON returns (return_date)")
+        # Same for returns: the date-range returns totals and per-product counts read only these
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_returns_cover ON returns (return_date, product_id, quantity, return_price)")
+        cur.execute("DROP INDEX IF EXISTS idx_returns_return_date")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_returns_product_id ON returns (product_id)")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_returns_original_bill_identifier ON returns (original_bill_identifier)")
 
+        # Bills table: one row per bill, written by checkout alongside its sales lines, so the
+        # bill-level discount can be summed without a DISTINCT over sales
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='bills'")
+        bills_exists = cur.fetchone() is not None
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS bills (
+            bill_identifier TEXT PRIMARY KEY,
+            sale_date TIMESTAMP,
+            discount REAL NOT NULL DEFAULT 0   -- sales.discount_applied_to_bill for the bill
+        )
+        ''')
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_bills_sale_date ON bills (sale_date, discount)")
+        if not bills_exists:
+            # One-time backfill; the distinct positive discounts per bill, as the analytics summed them
+            cur.execute('''
+            INSERT OR IGNORE INTO bills (bill_identifier, sale_date, discount)
+            SELECT bill_identifier, MIN(sale_date),
+                   COALESCE(SUM(DISTINCT CASE WHEN discount_applied_to_bill > 0 THEN discount_applied_to_bill END), 0)
+            FROM sales GROUP BY bill_identifier
+            ''')
+
+        # Daily sales roll-up for the period analytics, kept current by the insert triggers below
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='sales_daily'")
+        sales_daily_exists = cur.fetchone() is not None
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS sales_daily (
+            day TEXT PRIMARY KEY,              -- DATE(sale_date) / DATE(return_date)
+            gross_sales REAL NOT NULL DEFAULT 0,
+            discount_total REAL NOT NULL DEFAULT 0,
+            returns_value REAL NOT NULL DEFAULT 0,
+            items_qty INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        ''')
+        # Checkout stores a bill's discount on its first line only, so summing per line gives
+        # the per-bill discount total
+        cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS sales_daily_sale_ai AFTER INSERT ON sales
+        WHEN NEW.sale_date IS NOT NULL BEGIN
+            INSERT INTO sales_daily (day, gross_sales, discount_total, items_qty)
+            VALUES (DATE(NEW.sale_date), NEW.quantity * NEW.sale_price,
+                    MAX(COALESCE(NEW.discount_applied_to_bill, 0), 0), NEW.quantity)
+            ON CONFLICT(day) DO UPDATE SET
+                gross_sales = gross_sales + excluded.gross_sales,
+                discount_total = discount_total + excluded.discount_total,
+                items_qty = items_qty + excluded.items_qty;
+        END
+        ''')
+        cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS sales_daily_return_ai AFTER INSERT ON returns
+        WHEN NEW.return_date IS NOT NULL BEGIN
+            INSERT INTO sales_daily (day, returns_value) VALUES (DATE(NEW.return_date), NEW.quantity * NEW.return_price)
+            ON CONFLICT(day) DO UPDATE SET returns_value = returns_value + excluded.returns_value;
+        END
+        ''')
+        if not sales_daily_exists:
+            refresh_sales_daily(conn) # One-time backfill from the existing history
+
         # Discounts table - MODIFIED for discount type and value
         cur.execute('''
         CREATE TABLE IF NOT EXISTS discounts (
@@ -135,75 +308,224 @@ def init_db():
         ''')
         cur.execute("INSERT OR IGNORE INTO bill_sequence (id, last_bill_no) VALUES (1, 0)")
 
+        # Barcode Sequence table: highest numeric barcode handed out or saved so far
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS barcode_sequence (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_code INTEGER NOT NULL DEFAULT 99999999999
+        )
+        ''')
+        cur.execute("SELECT 1 FROM barcode_sequence WHERE id = 1")
+        if not cur.fetchone():
+            _seed_barcode_sequence(cur) # One-time scan of the barcodes already in products
+        # Numeric barcodes typed in by hand (add or edit) move the counter past themselves,
+        # so get_next_barcode() never hands out a code that is already taken
+        cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_barcode_sequence_ai AFTER INSERT ON products
+        WHEN NEW.barcode != '' AND trim(NEW.barcode, '0123456789') = '' BEGIN
+            UPDATE barcode_sequence SET last_code = CAST(NEW.barcode AS INTEGER)
+            WHERE id = 1 AND last_code < CAST(NEW.barcode AS INTEGER);
+        END
+        ''')
+        cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_barcode_sequence_au AFTER UPDATE OF barcode ON products
+        WHEN NEW.barcode != '' AND trim(NEW.barcode, '0123456789') = '' BEGIN
+            UPDATE barcode_sequence SET last_code = CAST(NEW.barcode AS INTEGER)
+            WHERE id = 1 AND last_code < CAST(NEW.barcode AS INTEGER);
+        END
+        ''')
+
         conn.commit()
         print("Database tables checked/created successfully (discounts table updated, sales.payment_method added).")
+        # Give the planner statistics for the indexes above: a full ANALYZE the first time, then
+        # PRAGMA optimize, which only re-analyzes tables whose stats have gone stale
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='sqlite_stat1'")
+        conn.execute("PRAGMA optimize" if cur.fetchone() else "ANALYZE")
     except sqlite3.Error as e:
         conn.rollback()
         print(f"Error initializing database schema: {e}")
     finally:
         conn.close()
 
-def get_next_bill_number():
+def refresh_sales_daily(conn=None, from_day=None, to_day=None):
+    """
+    Rebuilds sales_daily rows for days from_day..to_day ('YYYY-MM-DD', inclusive; None means
+    unbounded) from sales and returns. The triggers only see inserts, so call this after
+    editing or deleting sales/returns rows by hand. A given conn must already be in a
+    transaction; without one the rebuild runs in its own.
+    """
+    if conn is None:
+        conn = acquire_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE TRANSACTION')
+            refresh_sales_daily(conn, from_day, to_day)
+            conn.commit()
+        finally:
+            release_connection(conn)
+        return
+    day_filter, params = "", []
+    if from_day:
+        day_filter += " AND day >= ?"; params.append(from_day)
+    if to_day:
+        day_filter += " AND day <= ?"; params.append(to_day)
+    conn.execute("DELETE FROM sales_daily WHERE 1 = 1" + day_filter, params)
+    conn.execute(f"""
+        INSERT INTO sales_daily (day, gross_sales, discount_total, returns_value, items_qty)
+        SELECT day, SUM(gross_sales), SUM(discount_total), SUM(returns_value), SUM(items_qty)
+        FROM (
+            SELECT DATE(sale_date) AS day, quantity * sale_price AS gross_sales, 0 AS discount_total,
+                   0 AS returns_value, quantity AS items_qty
+            FROM sales WHERE sale_date IS NOT NULL
+            UNION ALL
+            SELECT DATE(sale_date), 0, discount, 0, 0
+            FROM bills WHERE sale_date IS NOT NULL AND discount > 0
+            UNION ALL
+            SELECT DATE(return_date), 0, 0, quantity * return_price, 0
+            FROM returns WHERE return_date IS NOT NULL
+        )
+        WHERE 1 = 1{day_filter}
+        GROUP BY day
+    """, params)
+
+def _init_products_fts(cur):
+    """
+    Creates a trigram FTS5 index over products.name, kept in sync by triggers.
+    Trigram tables can answer `name LIKE '%term%'` from the index, so product
+    search keeps its substring semantics. Skipped if this SQLite lacks FTS5.
+    """
+    global _products_fts_enabled
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='products_fts'")
+    already_exists = cur.fetchone() is not None
+    try:
+        cur.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts
+        USING fts5(name, content='products', content_rowid='id', tokenize='trigram')
+        """)
+    except sqlite3.OperationalError as e:
+        print(f"Warning: FTS5 trigram index unavailable, product search will scan the table: {e}")
+        _products_fts_enabled = False
+        return
+    cur.execute('''
+    CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts (rowid, name) VALUES (new.id, new.name);
+    END
+    ''')
+    cur.execute('''
+    CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts (products_fts, rowid, name) VALUES ('delete', old.id, old.name);
+    END
+    ''')
+    cur.execute('''
+    CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF name ON products BEGIN
+        INSERT INTO products_fts (products_fts, rowid, name) VALUES ('delete', old.id, old.name);
+        INSERT INTO products_fts (rowid, name) VALUES (new.id, new.name);
+    END
+    ''')
+    if not already_exists:
+        cur.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')") # Index existing products
+    _products_fts_enabled = True
+
+def products_fts_enabled():
+    """True when product name search can go through the products_fts index."""
+    return _products_fts_enabled
+
+def _claim_bill_number(cur):
+    """Increments bill_sequence and returns the claimed number; the caller owns the transaction."""
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        cur.execute("UPDATE bill_sequence SET last_bill_no = last_bill_no + 1 WHERE id = 1 RETURNING last_bill_no")
+        rows = cur.fetchall()
+    else:
+        cur.execute("UPDATE bill_sequence SET last_bill_no = last_bill_no + 1 WHERE id = 1")
+        rows = cur.execute("SELECT last_bill_no FROM bill_sequence WHERE id = 1").fetchall() if cur.rowcount else []
+    if rows:
+        return rows[0][0]
+    print("Warning: bill_sequence row not found, re-initializing.")
+    cur.execute("INSERT INTO bill_sequence (id, last_bill_no) VALUES (1, 1)")
+    return 1
+
+def get_next_bill_number(conn=None):
     """
     Retrieves the next sequential bill number atomically.
+    Pass the checkout connection (inside its open transaction) to claim the number in the
+    same transaction, so a rolled-back sale doesn't use up a number; errors then propagate.
     """
-    conn = connect_db()
+    if conn is not None:
+        return _claim_bill_number(conn.cursor())
+    conn = acquire_connection()
     cur = conn.cursor()
     next_bill_no = 1 
     try:
-        conn.execute('BEGIN IMMEDIATE TRANSACTION')
-        cur.execute("SELECT last_bill_no FROM bill_sequence WHERE id = 1")
-        row = cur.fetchone()
-        if row:
-            last_no = row[0]
-            next_bill_no = last_no + 1
-            cur.execute("UPDATE bill_sequence SET last_bill_no = ? WHERE id = 1", (next_bill_no,))
+        # UPDATE ... RETURNING is atomic on its own in autocommit mode; only the
+        # UPDATE-then-SELECT fallback needs an explicit write transaction around it
+        if sqlite3.sqlite_version_info >= (3, 35, 0):
+            next_bill_no = _claim_bill_number(cur)
         else:
-            print("Warning: bill_sequence row not found, re-initializing.")
-            cur.execute("INSERT INTO bill_sequence (id, last_bill_no) VALUES (1, ?)", (next_bill_no,))
-        conn.commit()
+            conn.execute('BEGIN IMMEDIATE TRANSACTION')
+            next_bill_no = _claim_bill_number(cur)
+            conn.commit()
     except sqlite3.Error as e:
         conn.rollback()
         print(f"Database error in get_next_bill_number: {e}. Falling back to default next_bill_no={next_bill_no}")
     finally:
-        conn.close()
+        release_connection(conn)
     return next_bill_no
 
+def _seed_barcode_sequence(cur):
+    """(Re)creates the barcode_sequence row from the highest numeric-only barcode in products."""
+    cur.execute("""
+        INSERT OR REPLACE INTO barcode_sequence (id, last_code)
+        SELECT 1, COALESCE(MAX(CAST(barcode AS INTEGER)), 99999999999)
+        FROM products
+        WHERE barcode IS NOT NULL AND barcode != '' AND trim(barcode, '0123456789') = ''
+    """)
+
+def _claim_barcode_number(cur):
+    """Increments barcode_sequence and returns the claimed number; mirrors _claim_bill_number()."""
+    for _ in range(2):
+        if sqlite3.sqlite_version_info >= (3, 35, 0):
+            cur.execute("UPDATE barcode_sequence SET last_code = last_code + 1 WHERE id = 1 RETURNING last_code")
+            rows = cur.fetchall()
+        else:
+            cur.execute("UPDATE barcode_sequence SET last_code = last_code + 1 WHERE id = 1")
+            rows = cur.execute("SELECT last_code FROM barcode_sequence WHERE id = 1").fetchall() if cur.rowcount else []
+        if rows:
+            return rows[0][0]
+        print("Warning: barcode_sequence row not found, re-seeding from products.")
+        _seed_barcode_sequence(cur)
+    raise sqlite3.DatabaseError("barcode_sequence could not be re-seeded")
+
 def get_next_barcode():
     """
-    Generate the next sequential barcode by incrementing the highest existing
-    numeric-only barcode.
+    Generate the next sequential barcode from barcode_sequence, which tracks the
+    highest numeric-only barcode. Each call claims a new code.
     """
-    conn = connect_db()
+    conn = acquire_connection()
     cur = conn.cursor()
     next_code = "100000000000" 
     try:
-        query = """
-            SELECT barcode
-            FROM products
-            WHERE barcode IS NOT NULL AND barcode != '' AND trim(barcode, '0123456789') = ''
-            ORDER BY CAST(barcode AS INTEGER) DESC
-            LIMIT 1
-        """
-        cur.execute(query)
-        result = cur.fetchone()
-        if result and result[0]:
-            try:
-                next_code_int = int(result[0]) + 1
-                next_code = str(next_code_int).zfill(12)
-            except (ValueError, TypeError) as e:
-                print(f"Warning: Could not convert barcode '{result[0]}' to int: {e}. Using default next code.")
+        if sqlite3.sqlite_version_info >= (3, 35, 0):
+            next_code = str(_claim_barcode_number(cur)).zfill(12)
+        else:
+            conn.execute('BEGIN IMMEDIATE TRANSACTION')
+            next_code = str(_claim_barcode_number(cur)).zfill(12)
+            conn.commit()
     except sqlite3.Error as e:
+        conn.rollback()
         print(f"Database error in get_next_barcode: {e}")
     finally:
-        conn.close()
+        release_connection(conn)
     return next_code
 
 # --- Discount CRUD Operations ---
-def create_discount(name: str, discount_type: str, value: float):
-    conn = connect_db()
+def create_discount(name: str, discount_type: str, value: float, conn=None):
+    """
+    Inserts one discount; a duplicate name raises sqlite3.IntegrityError.
+    Pass the request's connection (with no transaction open) to insert on it instead of a pooled one.
+    """
+    owns_conn = conn is None
+    if owns_conn:
+        conn = acquire_connection() # discounts has no foreign keys, so the pooled defaults are fine
     cur = conn.cursor()
-    cur.execute("PRAGMA foreign_keys = ON")
     try:
         conn.execute('BEGIN')
         cur.execute(
@@ -211,6 +533,7 @@ def create_discount(name: str, discount_type: str, value: float):
             (name.strip().upper(), discount_type, value)
         )
         conn.commit()
+        _invalidate_discounts_cache()
     except sqlite3.IntegrityError as e:
         conn.rollback()
         raise
@@ -218,35 +541,48 @@ def create_discount(name: str, discount_type: str, value: float):
         conn.rollback()
         raise
     finally:
-        conn.close()
+        if owns_conn:
+            release_connection(conn)
 
-def get_all_discounts():
-    conn = connect_db()
-    conn.row_factory = sqlite3.Row 
+def _invalidate_discounts_cache():
+    global _discounts_version
+    with _discounts_version_lock:
+        _discounts_version += 1
+
+@functools.lru_cache(maxsize=8)
+def _load_discounts(discounts_version):
+    conn = acquire_connection()
     cur = conn.cursor()
-    rows = []
+    cur.row_factory = None # Plain (id, name, type, value) tuples; the pooled default is sqlite3.Row
     try:
         cur.execute('SELECT id, name, discount_type, value FROM discounts ORDER BY name')
-        rows_raw = cur.fetchall()
-        rows = [tuple(row) for row in rows_raw] # Convert Row objects to tuples (id, name, type, value)
-    except sqlite3.Error as e:
-        print(f"Database error in get_all_discounts: {e}")
+        return cur.fetchall()
     finally:
-        conn.close()
-    return rows
+        release_connection(conn)
+
+def get_all_discounts():
+    """
+    Returns every discount as (id, name, type, value) tuples. The list is cached until
+    create_discount() changes it; failed reads are not cached.
+    """
+    try:
+        return _load_discounts(_discounts_version)
+    except sqlite3.Error as e: # lru_cache doesn't store exceptions, so the next call retries
+        print(f"Database error in get_all_discounts: {e}")
+        return []
 
 def get_discount(discount_id: int):
-    conn = connect_db()
-    conn.row_factory = sqlite3.Row
+    conn = acquire_connection()
     cur = conn.cursor()
+    cur.row_factory = None # Plain (id, name, type, value) tuple; the pooled default is sqlite3.Row
     row_obj = None
     try:
         cur.execute('SELECT id, name, discount_type, value FROM discounts WHERE id = ?', (discount_id,))
         row_obj = cur.fetchone()
         if row_obj:
-            return tuple(row_obj) # Convert Row object to tuple (id, name, type, value)
+            return row_obj
     except sqlite3.Error as e:
         print(f"Database error in get_discount (id={discount_id}): {e}")
     finally:
-        conn.close()
+        release_connection(conn)
     return None
\ No newline at end of file
@@ -0,0 +1,65 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("openpyxl")
+pytest.importorskip("barcode")
+
+from jinja2 import ChoiceLoader, FileSystemLoader, FunctionLoader
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Most templates live outside this tree; pages extending base.html still render their content
+# block, and any other missing template renders just the flashed messages
+STUB_BASE_TEMPLATE = "{% for message in get_flashed_messages() %}{{ message }}\n{% endfor %}{% block content %}{% endblock %}"
+STUB_PAGE_TEMPLATE = "{% for message in get_flashed_messages() %}{{ message }}\n{% endfor %}"
+
+
+def _stub_template(name):
+    return STUB_BASE_TEMPLATE if name == "base.html" else STUB_PAGE_TEMPLATE
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    # app.py initialises instance/toystore.db under the working directory on import, and the
+    # connection pool and caches live in models/utils, so all three are imported fresh per test
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(ROOT)
+    for module in ("app", "utils", "models"):
+        sys.modules.pop(module, None)
+    app_module = importlib.import_module("app")
+    app_module.app.config["TESTING"] = True
+    app_module.app.static_folder = str(tmp_path / "static") # Barcode PNGs stay out of the repo
+    app_module.app.jinja_env.loader = ChoiceLoader([
+        app_module.app.jinja_env.loader, FileSystemLoader(ROOT), FunctionLoader(_stub_template)
+    ])
+    return app_module
+
+
+@pytest.fixture
+def client(app_module):
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session["user"] = "tester"
+        session["user_id"] = 1
+        session["role"] = "admin"
+    return client
+
+
+@pytest.fixture
+def db(app_module):
+    conn = app_module.acquire_connection()
+    yield conn
+    app_module.release_connection(conn)
+
+
+@pytest.fixture
+def flashes(client):
+    """Returns a callable giving the messages flashed so far (and not yet rendered)."""
+    def read():
+        with client.session_transaction() as session:
+            return [message for _, message in session.get("_flashes", [])]
+    return read
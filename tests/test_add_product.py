@@ -0,0 +1,56 @@
+import html
+
+import pytest
+
+
+@pytest.fixture(params=[True, False], ids=["returning", "no-returning"])
+def returning(request, app_module, monkeypatch):
+    # Also run each case down the SQLite < 3.35 path (plain INSERT, rowcount/lastrowid)
+    monkeypatch.setattr(app_module, "SQLITE_SUPPORTS_RETURNING", request.param)
+    return request.param
+
+
+@pytest.fixture
+def category_id(db):
+    return db.execute("INSERT INTO categories (name) VALUES ('Toys')").lastrowid
+
+
+def _product_form(category_id, barcode=""):
+    return {"name": "Yo-yo", "cost_price": "10", "selling_price": "15", "quantity": "3",
+            "category_id": str(category_id), "barcode": barcode}
+
+
+def _page_text(response):
+    return html.unescape(response.get_data(as_text=True))
+
+
+def _barcodes(db):
+    return sorted(row[0] for row in db.execute("SELECT barcode FROM products"))
+
+
+def test_add_product_rejects_taken_barcode(client, db, category_id, returning):
+    assert client.post("/add-product", data=_product_form(category_id, "TOY-1")).status_code == 302
+    response = client.post("/add-product", data=_product_form(category_id, "TOY-1"))
+
+    assert response.status_code == 200 # Form is shown again
+    assert "Barcode 'TOY-1' already exists" in _page_text(response)
+    assert _barcodes(db) == ["TOY-1"]
+
+
+def test_add_product_retries_colliding_generated_barcode(app_module, client, db, flashes, category_id, returning, monkeypatch):
+    db.execute("INSERT INTO products (name, cost_price, selling_price, quantity, category_id, barcode) "
+               "VALUES ('Kite', 1, 2, 1, ?, '000000000123')", (category_id,))
+    monkeypatch.setattr(app_module, "get_next_barcode", lambda: "000000000123")
+
+    response = client.post("/add-product", data=_product_form(category_id))
+
+    assert response.status_code == 302
+    assert _barcodes(db) == ["000000000123", "000000000124"]
+    assert "Product 'Yo-yo' added with barcode 000000000124" in flashes()
+
+
+def test_add_product_reports_missing_category(client, db, category_id, returning):
+    response = client.post("/add-product", data=_product_form(category_id + 1, "TOY-2"))
+
+    assert "Selected category does not exist." in _page_text(response)
+    assert _barcodes(db) == []
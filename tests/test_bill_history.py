@@ -0,0 +1,51 @@
+import re
+
+import pytest
+
+
+@pytest.fixture
+def bills(db):
+    """Five single-line bills, numbered 1 to 5."""
+    category_id = db.execute("INSERT INTO categories (name) VALUES ('Toys')").lastrowid
+    product_id = db.execute("INSERT INTO products (name, cost_price, selling_price, quantity, category_id, barcode) "
+                            "VALUES ('Kite', 1, 2, 10, ?, 'KITE')", (category_id,)).lastrowid
+    for bill_no in range(1, 6):
+        db.execute("INSERT INTO sales (bill_identifier, product_id, quantity, sale_price, sale_date, payment_method) "
+                   "VALUES (?, ?, 1, 2, ?, 'Cash')", (str(bill_no), product_id, f"2026-01-0{bill_no} 10:00:00"))
+    return list(range(1, 6))
+
+
+def _bill_history(client, **params):
+    response = client.get("/bill-history", query_string=params)
+    assert response.status_code == 200
+    page = response.get_data(as_text=True)
+    shown = [int(bill_no) for bill_no in re.findall(r"Bill No: (\d+)", page)]
+    links = {label: (int(page_no), int(size)) for page_no, size, label in
+             re.findall(r'href="/bill-history\?page=(-?\d+)&(?:amp;)?size=(\d+)"[^>]*>(?:<i[^>]*></i>)?(Newer|Older)', page)}
+    return shown, links
+
+
+def test_first_page_links_only_to_older_bills(client, bills):
+    shown, links = _bill_history(client, size=2)
+    assert shown == [5, 4]
+    assert links == {"Older": (2, 2)}
+
+
+def test_middle_and_last_pages(client, bills):
+    assert _bill_history(client, page=2, size=2) == ([3, 2], {"Newer": (1, 2), "Older": (3, 2)})
+    assert _bill_history(client, page=3, size=2) == ([1], {"Newer": (2, 2)})
+
+
+def test_page_past_the_end_links_back(client, bills):
+    assert _bill_history(client, page=9, size=2) == ([], {"Newer": (8, 2)})
+
+
+def test_page_and_size_are_clamped(app_module, client, bills, monkeypatch):
+    assert _bill_history(client, page=0, size=2) == ([5, 4], {"Older": (2, 2)})
+    assert _bill_history(client, page=-3, size=0) == ([5], {"Older": (2, 1)})
+    monkeypatch.setattr(app_module, "BILL_HISTORY_MAX_PAGE_SIZE", 3)
+    assert _bill_history(client, size=1000) == ([5, 4, 3], {"Older": (2, 3)})
+
+
+def test_default_page_shows_every_bill_without_pager(client, bills):
+    assert _bill_history(client) == ([5, 4, 3, 2, 1], {})
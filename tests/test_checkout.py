@@ -0,0 +1,56 @@
+import pytest
+
+
+@pytest.fixture
+def products(db):
+    category_id = db.execute("INSERT INTO categories (name) VALUES ('Toys')").lastrowid
+    ids = {}
+    for name, stock in (("Kite", 5), ("Yo-yo", 1)):
+        ids[name] = db.execute("INSERT INTO products (name, cost_price, selling_price, quantity, category_id, barcode) "
+                               "VALUES (?, 1, 2, ?, ?, ?)", (name, stock, category_id, name.upper())).lastrowid
+    return ids
+
+
+def _add_to_cart(client, product_id, times=1):
+    for _ in range(times):
+        assert client.post("/billing", data={"select_product_id": str(product_id)}).status_code == 302
+
+
+def _checkout(client):
+    return client.post("/billing", data={"checkout_and_print": "1", "payment_method": "Cash"})
+
+
+def _stock(db):
+    return dict(db.execute("SELECT name, quantity FROM products"))
+
+
+def _last_bill_no(db):
+    return db.execute("SELECT last_bill_no FROM bill_sequence WHERE id = 1").fetchone()[0]
+
+
+def test_checkout_with_insufficient_stock_rolls_back(client, db, flashes, products):
+    _add_to_cart(client, products["Kite"])
+    _add_to_cart(client, products["Yo-yo"], times=2) # Only one in stock
+    bill_no_before = _last_bill_no(db)
+    flashes() # Drop the "Added ..." messages
+
+    response = _checkout(client)
+
+    assert response.status_code == 302
+    assert "Insufficient stock for 'Yo-yo'. Sale aborted." in flashes()
+    assert db.execute("SELECT COUNT(*) FROM sales").fetchone()[0] == 0
+    assert db.execute("SELECT COUNT(*) FROM bills").fetchone()[0] == 0
+    assert _last_bill_no(db) == bill_no_before # The bill number is not consumed
+    assert _stock(db) == {"Kite": 5, "Yo-yo": 1}
+
+
+def test_checkout_records_sale_and_decrements_stock(client, db, products):
+    _add_to_cart(client, products["Kite"], times=2)
+    _add_to_cart(client, products["Yo-yo"])
+    bill_no_before = _last_bill_no(db)
+
+    _checkout(client)
+
+    assert _stock(db) == {"Kite": 3, "Yo-yo": 0}
+    assert [row[0] for row in db.execute("SELECT bill_identifier FROM bills")] == [str(bill_no_before + 1)]
+    assert db.execute("SELECT SUM(quantity) FROM sales").fetchone()[0] == 3
@@ -0,0 +1,19 @@
+from flask import template_rendered
+
+
+def test_validation_error_rerender_keeps_stored_barcode(app_module, client, db):
+    category_id = db.execute("INSERT INTO categories (name) VALUES ('Toys')").lastrowid
+    product_id = db.execute("INSERT INTO products (name, cost_price, selling_price, quantity, category_id, barcode) "
+                            "VALUES ('Kite', 1, 2, 3, ?, 'KITE-1')", (category_id,)).lastrowid
+    rendered = []
+    record = lambda sender, template, context, **extra: rendered.append((template.name, context))
+
+    with template_rendered.connected_to(record, app_module.app):
+        client.post(f"/edit-product/{product_id}", data={
+            "name": "Kite", "cost_price": "-1", "selling_price": "2", "quantity": "3", "category_id": str(category_id)
+        })
+
+    name, context = rendered[0]
+    assert name == "edit_product.html"
+    assert context["product"]["barcode"] == "KITE-1"
+    assert context["product"]["cost_price"] == -1.0 # Submitted values are kept
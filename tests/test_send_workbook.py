@@ -0,0 +1,25 @@
+import glob
+import os
+import tempfile
+
+from werkzeug.test import create_environ
+
+
+def test_send_workbook_leaves_no_temp_file(app_module):
+    before = set(glob.glob(os.path.join(tempfile.gettempdir(), "*.xlsx")))
+    wb = app_module._new_export_workbook()
+    ws = wb.create_sheet(title="Sheet")
+    ws.append([app_module._bold_cell(ws, "Header")])
+    ws.append([1.5])
+
+    environ = create_environ("/export")
+    with app_module.app.request_context(environ):
+        response = app_module._send_workbook(wb, "export.xlsx")
+    # Drive the response the way a WSGI server does: iterate it, then close the iterable
+    app_iter = response(environ, lambda status, headers, exc_info=None: None)
+    body = b"".join(app_iter)
+    app_iter.close()
+
+    assert body.startswith(b"PK") # xlsx is a zip archive
+    assert "export.xlsx" in response.headers["Content-Disposition"]
+    assert set(glob.glob(os.path.join(tempfile.gettempdir(), "*.xlsx"))) == before
@@ -2,9 +2,35 @@ import os
 import re
 import sys # Added for PyInstaller path handling
 import barcode
-from barcode.writer import ImageWriter
+import functools
+import logging
+from PIL import Image, ImageDraw, ImageFont # Pillow; already required by python-barcode's image output
 from datetime import datetime, timedelta, UTC # Import UTC
 import sqlite3 # Added to handle sqlite3.Error in get_sales_analytics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from models import acquire_connection, release_connection
+
+logger = logging.getLogger(__name__)
+
+# --- Analytics Result Cache ---
+# Dashboard aggregates barely move between page loads, so results are kept in
+# memory for a short time. Routes that write sales/products/returns call
+# clear_analytics_cache() so a fresh write is never hidden behind the TTL.
+ANALYTICS_CACHE_TTL = 60 # seconds, for the rolling dashboard metrics
+CUSTOM_RANGE_CACHE_TTL = 600 # seconds, custom ranges are mostly historical
+# All-time metrics that only move when a sale is recorded: their cache key carries the newest
+# sales id, so a new sale (even from another process) misses and they can be kept longer
+SALES_STAMPED_PERIODS = ('best_sellers', 'unsold')
+SALES_STAMPED_CACHE_TTL = 600 # seconds
+ANALYTICS_CACHE_MAXSIZE = 64
+_analytics_cache = {} # key -> (expires_at, result)
+_analytics_cache_lock = threading.Lock()
+
+# Metrics rendered on the dashboard; fetched together by get_sales_analytics_bulk()
+DASHBOARD_METRICS = ('best_sellers', 'unsold', 'daily', 'weekly', 'monthly', 'yearly')
+_analytics_executor = ThreadPoolExecutor(max_workers=len(DASHBOARD_METRICS), thread_name_prefix='analytics')
 
 # --- PyInstaller Path Helper ---
 def _resource_path_utils(relative_path):
@@ -15,22 +41,120 @@ def _resource_path_utils(relative_path):
         base_path = os.path.dirname(os.path.abspath(__file__)) 
     return os.path.join(base_path, relative_path)
 
-def generate_barcode(product_code: str, output_filename_base: str):
+# --- Barcode Images ---
+# Same geometry as python-barcode's ImageWriter defaults for Code128 (sizes in mm at 300 dpi), so
+# labels look as before; the bars and text are drawn straight onto one Pillow image instead of
+# going through the writer's per-module callbacks and a font load on every save
+BARCODE_DPI = 300
+BARCODE_MODULE_WIDTH = 0.2
+BARCODE_MODULE_HEIGHT = 15.0
+BARCODE_QUIET_ZONE = 2.54
+BARCODE_MARGIN = 1.0 # top and bottom
+BARCODE_TEXT_DISTANCE = 5.0
+BARCODE_FONT_SIZE_MM = 10 * 0.352777778 # 10 pt
+
+def _mm_to_px(mm):
+    return mm * BARCODE_DPI / 25.4
+
+@functools.lru_cache(maxsize=1)
+def _barcode_font():
+    font_path = os.path.join(os.path.dirname(barcode.__file__), 'fonts', 'DejaVuSansMono.ttf')
+    return ImageFont.truetype(font_path, int(_mm_to_px(BARCODE_FONT_SIZE_MM)))
+
+def _render_code128(product_code):
+    """Code128 image for `product_code`: bars from python-barcode's encoder, code printed underneath."""
+    modules = barcode.get('code128', product_code).build()[0] # '1' = bar, '0' = space
+    width_mm = 2 * BARCODE_QUIET_ZONE + len(modules) * BARCODE_MODULE_WIDTH
+    height_mm = 2 * BARCODE_MARGIN + BARCODE_MODULE_HEIGHT + BARCODE_FONT_SIZE_MM / 2 + BARCODE_TEXT_DISTANCE
+    image = Image.new('L', (int(_mm_to_px(width_mm)), int(_mm_to_px(height_mm))), 255)
+    draw = ImageDraw.Draw(image)
+    top, bottom = _mm_to_px(BARCODE_MARGIN), _mm_to_px(BARCODE_MARGIN + BARCODE_MODULE_HEIGHT)
+    for bar in re.finditer('1+', modules): # One rectangle per run of adjacent bar modules
+        x_start = BARCODE_QUIET_ZONE + bar.start() * BARCODE_MODULE_WIDTH
+        x_end = BARCODE_QUIET_ZONE + bar.end() * BARCODE_MODULE_WIDTH
+        draw.rectangle([(_mm_to_px(x_start), top), (_mm_to_px(x_end) - 1, bottom)], fill=0)
+    text_pos = (_mm_to_px(BARCODE_QUIET_ZONE + len(modules) * BARCODE_MODULE_WIDTH / 2),
+                _mm_to_px(BARCODE_MARGIN + BARCODE_MODULE_HEIGHT + BARCODE_TEXT_DISTANCE))
+    draw.text(text_pos, product_code, font=_barcode_font(), fill=0, anchor='md')
+    return image
+
+_ensured_barcode_dirs = set() # Output directories generate_barcode() has already created/checked
+
+def generate_barcode(product_code: str, output_filename_base: str = None, buffer=None):
+    """
+    Saves the Code128 PNG for `product_code` to `output_filename_base` + '.png' and returns that path.
+    If a binary file-like `buffer` (e.g. io.BytesIO) is given instead, the PNG is written to it,
+    nothing touches the disk, and `buffer` is returned.
+    """
     if not product_code:
         raise ValueError("Product code cannot be empty for barcode generation.")
+    if buffer is not None:
+        _render_code128(str(product_code)).save(buffer, 'PNG', compress_level=1)
+        return buffer
     if not output_filename_base:
         raise ValueError("Output filename base cannot be empty for barcode generation.")
+    output_dir = os.path.dirname(output_filename_base)
     try:
-        output_dir = os.path.dirname(output_filename_base)
-        os.makedirs(output_dir, exist_ok=True)
-        code128 = barcode.get('code128', str(product_code), writer=ImageWriter())
-        saved_path = code128.save(output_filename_base)
-        print(f"Barcode image saved to: {saved_path}")
+        if output_dir not in _ensured_barcode_dirs:
+            os.makedirs(output_dir, exist_ok=True)
+            _ensured_barcode_dirs.add(output_dir)
+        saved_path = f"{output_filename_base}.png"
+        _render_code128(str(product_code)).save(saved_path, 'PNG', compress_level=1)
+        logger.info("Barcode image saved to: %s", saved_path)
         return saved_path
-    except Exception as e:
-        print(f"Error generating or saving barcode for code '{product_code}' at '{output_filename_base}': {e}")
+    except Exception:
+        _ensured_barcode_dirs.discard(output_dir) # e.g. the folder was removed; recreate it next time
+        logger.exception("Error generating or saving barcode for code '%s' at '%s'", product_code, output_filename_base)
         raise
 
+# Custom-range top sellers. Both run on pooled connections alongside the range totals; returns
+# are grouped once per product and joined, rather than re-summed per product in both the
+# SELECT list and the ORDER BY
+SQL_TOP_SELLERS_BY_NET_QTY = """
+        SELECT 
+            p.id, p.name,
+            SUM(s.quantity) as gross_sold_qty,
+            COALESCE(ret.qty, 0) as returned_qty
+        FROM sales s
+        JOIN products p ON s.product_id = p.id
+        LEFT JOIN (
+            SELECT r.product_id, SUM(r.quantity) as qty
+            FROM returns r
+            WHERE :has_returns AND r.return_date >= :from_date AND r.return_date < :range_end
+            GROUP BY r.product_id
+        ) ret ON ret.product_id = p.id
+        WHERE s.sale_date >= :from_date AND s.sale_date < :range_end
+        GROUP BY p.id, p.name
+        ORDER BY (SUM(s.quantity) - COALESCE(ret.qty, 0)) DESC
+        LIMIT 5
+"""
+SQL_TOP_SELLERS_BY_GROSS_REVENUE = """
+        SELECT 
+            p.id, p.name,
+            SUM(s.quantity * s.sale_price) as gross_revenue,
+            SUM(s.quantity) as gross_sold_qty,
+            COALESCE(ret.qty, 0) as returned_qty
+        FROM sales s
+        JOIN products p ON s.product_id = p.id
+        LEFT JOIN (
+            SELECT r.product_id, SUM(r.quantity) as qty
+            FROM returns r
+            WHERE :has_returns AND r.return_date >= :from_date AND r.return_date < :range_end
+            GROUP BY r.product_id
+        ) ret ON ret.product_id = p.id
+        WHERE s.sale_date >= :from_date AND s.sale_date < :range_end
+        GROUP BY p.id, p.name
+        ORDER BY gross_revenue DESC
+        LIMIT 5
+"""
+
+def _fetchall_on_pooled_connection(sql, params):
+    conn = acquire_connection()
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        release_connection(conn)
+
 def get_custom_range_analytics(conn, from_date_str: str, to_date_str: str):
     """
     Get detailed sales analytics for a custom date range.
@@ -39,57 +163,67 @@ def get_custom_range_analytics(conn, from_date_str: str, to_date_str: str):
         return None # Indicate error or no connection
     if not from_date_str or not to_date_str:
         return None # Invalid date range
+    # Half-open [from, day after to) range on the raw timestamps, so the sale_date/return_date
+    # indexes can serve it; DATE(col) BETWEEN ... had to evaluate DATE() on every row
+    try:
+        range_end = (datetime.strptime(to_date_str, '%Y-%m-%d') + timedelta(days=1)).date().isoformat()
+    except ValueError:
+        return None # Invalid date range
 
     cur = conn.cursor()
     analytics = {}
 
     try:
-        # 1. Total Gross Sales
+        # Returns and sales totals (value, bills, items, cost at current cost_price) each take one
+        # pass over the range, instead of a separate scan/join per figure
         cur.execute("""
-            SELECT SUM(s.quantity * s.sale_price)
+            SELECT SUM(r.quantity * r.return_price), SUM(r.quantity * p.cost_price)
+            FROM returns r
+            LEFT JOIN products p ON r.product_id = p.id
+            WHERE r.return_date >= ? AND r.return_date < ?
+        """, (from_date_str, range_end))
+        returns_value, total_cost_of_returned_goods = cur.fetchone()
+        # SUM() over no rows is NULL: with no returns in the range the top-seller queries pass
+        # has_returns=0, a constant term SQLite checks once before (and instead of) the returns scan
+        has_returns = int(returns_value is not None)
+        # The two top-seller queries are the heaviest here; they run concurrently on pooled
+        # connections (WAL lets readers overlap) while `conn` works through the totals below
+        top_seller_params = {"from_date": from_date_str, "range_end": range_end, "has_returns": has_returns}
+        top_by_qty_future = _analytics_executor.submit(_fetchall_on_pooled_connection, SQL_TOP_SELLERS_BY_NET_QTY, top_seller_params)
+        top_by_revenue_future = _analytics_executor.submit(_fetchall_on_pooled_connection, SQL_TOP_SELLERS_BY_GROSS_REVENUE, top_seller_params)
+
+        cur.execute("""
+            SELECT SUM(s.quantity * s.sale_price), COUNT(DISTINCT s.bill_identifier),
+                   SUM(s.quantity), SUM(s.quantity * p.cost_price)
             FROM sales s
-            WHERE DATE(s.sale_date) BETWEEN ? AND ?
-        """, (from_date_str, to_date_str))
-        analytics['total_gross_sales'] = cur.fetchone()[0] or 0.0
+            LEFT JOIN products p ON s.product_id = p.id
+            WHERE s.sale_date >= ? AND s.sale_date < ?
+        """, (from_date_str, range_end))
+        gross_sales, number_of_bills, items_sold, total_cost_of_gross_sales = cur.fetchone()
+
+        # 1. Total Gross Sales
+        analytics['total_gross_sales'] = gross_sales or 0.0
 
         # 2. Total Discounts Applied on Bills
-        # Sum distinct discount_applied_to_bill per bill_identifier
+        # One row per bill in `bills`, so its discounts sum directly
         cur.execute("""
-            SELECT SUM(unique_discounts.discount_amount)
-            FROM (
-                SELECT DISTINCT s.bill_identifier, s.discount_applied_to_bill AS discount_amount
-                FROM sales s
-                WHERE DATE(s.sale_date) BETWEEN ? AND ? AND s.discount_applied_to_bill > 0
-            ) unique_discounts
-        """, (from_date_str, to_date_str))
+            SELECT SUM(b.discount)
+            FROM bills b
+            WHERE b.sale_date >= ? AND b.sale_date < ? AND b.discount > 0
+        """, (from_date_str, range_end))
         analytics['total_discounts_on_bills'] = cur.fetchone()[0] or 0.0
         
         # 3. Total Value of Returns
-        cur.execute("""
-            SELECT SUM(r.quantity * r.return_price)
-            FROM returns r
-            WHERE DATE(r.return_date) BETWEEN ? AND ?
-        """, (from_date_str, to_date_str))
-        analytics['total_returns_value'] = cur.fetchone()[0] or 0.0
+        analytics['total_returns_value'] = returns_value or 0.0
 
         # 4. Net Sales
         analytics['total_net_sales'] = analytics['total_gross_sales'] - analytics['total_discounts_on_bills'] - analytics['total_returns_value']
 
         # 5. Number of Bills (Transactions)
-        cur.execute("""
-            SELECT COUNT(DISTINCT s.bill_identifier)
-            FROM sales s
-            WHERE DATE(s.sale_date) BETWEEN ? AND ?
-        """, (from_date_str, to_date_str))
-        analytics['number_of_bills'] = cur.fetchone()[0] or 0
+        analytics['number_of_bills'] = number_of_bills or 0
 
         # 6. Total Items Sold (Gross Quantity)
-        cur.execute("""
-            SELECT SUM(s.quantity)
-            FROM sales s
-            WHERE DATE(s.sale_date) BETWEEN ? AND ?
-        """, (from_date_str, to_date_str))
-        analytics['total_items_sold_gross_qty'] = cur.fetchone()[0] or 0
+        analytics['total_items_sold_gross_qty'] = items_sold or 0
 
         # 7. Average Items per Bill
         analytics['avg_items_per_bill'] = (analytics['total_items_sold_gross_qty'] / analytics['number_of_bills']) if analytics['number_of_bills'] > 0 else 0.0
@@ -99,23 +233,11 @@ def get_custom_range_analytics(conn, from_date_str: str, to_date_str: str):
 
         # --- Profit Calculation ---
         # 9.a. Total Cost of Gross Sales (using current cost_price)
-        cur.execute("""
-            SELECT SUM(s.quantity * p.cost_price)
-            FROM sales s
-            JOIN products p ON s.product_id = p.id
-            WHERE DATE(s.sale_date) BETWEEN ? AND ?
-        """, (from_date_str, to_date_str))
-        total_cost_of_gross_sales = cur.fetchone()[0] or 0.0
+        total_cost_of_gross_sales = total_cost_of_gross_sales or 0.0
         analytics['total_cost_of_gross_sales'] = total_cost_of_gross_sales
 
         # 9.b. Total Cost of Returned Goods (using current cost_price)
-        cur.execute("""
-            SELECT SUM(r.quantity * p.cost_price)
-            FROM returns r
-            JOIN products p ON r.product_id = p.id
-            WHERE DATE(r.return_date) BETWEEN ? AND ?
-        """, (from_date_str, to_date_str))
-        total_cost_of_returned_goods = cur.fetchone()[0] or 0.0
+        total_cost_of_returned_goods = total_cost_of_returned_goods or 0.0
         analytics['total_cost_of_returned_goods'] = total_cost_of_returned_goods
 
         # 9.c. Total Net Cost of Goods Sold
@@ -123,65 +245,73 @@ def get_custom_range_analytics(conn, from_date_str: str, to_date_str: str):
         analytics['estimated_total_profit'] = analytics['total_net_sales'] - analytics['total_net_cogs']
 
         # 9. Top 5 Selling Products (by net quantity: sold_qty - returned_qty)
-        cur.execute("""
-            SELECT 
-                p.id, p.name,
-                SUM(s.quantity) as gross_sold_qty,
-                (SELECT COALESCE(SUM(r.quantity), 0) FROM returns r WHERE r.product_id = p.id AND DATE(r.return_date) BETWEEN :from_date AND :to_date) as returned_qty
-            FROM sales s
-            JOIN products p ON s.product_id = p.id
-            WHERE DATE(s.sale_date) BETWEEN :from_date AND :to_date
-            GROUP BY p.id, p.name
-            ORDER BY (SUM(s.quantity) - (SELECT COALESCE(SUM(r.quantity), 0) FROM returns r WHERE r.product_id = p.id AND DATE(r.return_date) BETWEEN :from_date AND :to_date)) DESC
-            LIMIT 5
-        """, {"from_date": from_date_str, "to_date": to_date_str})
-        top_sellers_by_qty_raw = cur.fetchall()
-        analytics['top_sellers_by_net_qty'] = []
-        for row in top_sellers_by_qty_raw:
-            net_sold_qty = (row['gross_sold_qty'] or 0) - (row['returned_qty'] or 0)
-            analytics['top_sellers_by_net_qty'].append({
-                'id': row['id'], 'name': row['name'], 'net_sold_qty': net_sold_qty, 'gross_sold_qty': row['gross_sold_qty'], 'returned_qty': row['returned_qty']
-            })
+        # Rows are unpacked in SELECT-list order rather than looked up by column name
+        analytics['top_sellers_by_net_qty'] = [
+            {'id': product_id, 'name': name, 'net_sold_qty': (gross_sold_qty or 0) - (returned_qty or 0),
+             'gross_sold_qty': gross_sold_qty, 'returned_qty': returned_qty}
+            for product_id, name, gross_sold_qty, returned_qty in top_by_qty_future.result()
+        ]
         
         # 10. Top 5 Selling Products (by net revenue: (sold_qty * sale_price) - (returned_qty * return_price_avg_for_product)
         # This is complex due to varying sale/return prices. Simpler: Top by gross revenue, then show net units.
-        cur.execute("""
-            SELECT 
-                p.id, p.name,
-                SUM(s.quantity * s.sale_price) as gross_revenue,
-                SUM(s.quantity) as gross_sold_qty,
-                (SELECT COALESCE(SUM(r.quantity), 0) FROM returns r WHERE r.product_id = p.id AND DATE(r.return_date) BETWEEN :from_date AND :to_date) as returned_qty
-            FROM sales s
-            JOIN products p ON s.product_id = p.id
-            WHERE DATE(s.sale_date) BETWEEN :from_date AND :to_date
-            GROUP BY p.id, p.name
-            ORDER BY gross_revenue DESC
-            LIMIT 5
-        """, {"from_date": from_date_str, "to_date": to_date_str})
-        top_sellers_by_revenue_raw = cur.fetchall()
-        analytics['top_sellers_by_gross_revenue'] = []
-        for row in top_sellers_by_revenue_raw:
-             analytics['top_sellers_by_gross_revenue'].append({
-                'id': row['id'], 'name': row['name'], 'gross_revenue': row['gross_revenue'] or 0.0,
-                'gross_sold_qty': row['gross_sold_qty'] or 0, 'returned_qty': row['returned_qty'] or 0
-            })
+        analytics['top_sellers_by_gross_revenue'] = [
+            {'id': product_id, 'name': name, 'gross_revenue': gross_revenue or 0.0,
+             'gross_sold_qty': gross_sold_qty or 0, 'returned_qty': returned_qty or 0}
+            for product_id, name, gross_revenue, gross_sold_qty, returned_qty in top_by_revenue_future.result()
+        ]
         
         return analytics
 
     except sqlite3.Error as e:
-        print(f"Database error during custom range analytics: {e}")
+        logger.exception("Database error during custom range analytics")
         return {"error": str(e)} # Return error info
-    except Exception as e:
-        print(f"Unexpected error during custom range analytics: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        logger.exception("Unexpected error during custom range analytics")
         return {"error": "An unexpected error occurred."}
 
 
+# Period -> SQL expression bucketing a sales_daily day ({} is the day column)
+PERIOD_BUCKETS = {
+    'daily': "DATE({})",
+    # Each row's ISO week Monday: the next Sunday (or the same day), less six days
+    'weekly': "DATE({}, 'weekday 0', '-6 days')",
+    'monthly': "strftime('%Y-%m', {})",
+    'yearly': "strftime('%Y', {})",
+}
+# Built once so every call passes sqlite3 the same text and hits its per-connection statement cache
+SQL_PERIOD_TOTALS = {
+    period: f"""
+        SELECT {bucket_sql.format('d.day')} AS bucket,
+               SUM(d.gross_sales), SUM(d.discount_total), SUM(d.returns_value)
+        FROM sales_daily d WHERE d.day >= ? GROUP BY bucket
+    """
+    for period, bucket_sql in PERIOD_BUCKETS.items()
+}
+
+def _period_totals(cur, period, since_date_str):
+    """
+    Gross sales, bill discounts and returns from `since_date_str` on, grouped by the
+    PERIOD_BUCKETS bucket of `period`, read from the sales_daily roll-up (one row per day)
+    in a single query. Returns a dict of bucket value -> (gross, discounts, returns).
+    """
+    cur.execute(SQL_PERIOD_TOTALS[period], (since_date_str,))
+    return {row[0]: (row[1] or 0.0, row[2] or 0.0, row[3] or 0.0) for row in cur.fetchall()}
+
+def _period_row(totals, bucket):
+    """The rounded totals for one bucket of _period_totals() output."""
+    gross_sales, total_discounts_on_bills, total_returns_value = totals.get(bucket, (0.0, 0.0, 0.0)) # Gross Sales first
+    net_sales = gross_sales - total_discounts_on_bills - total_returns_value
+    return {
+        'total_sales': round(gross_sales, 2),
+        'total_discounts_on_bills': round(total_discounts_on_bills, 2),
+        'total_returns_value': round(total_returns_value, 2),
+        'net_sales': round(net_sales, 2)
+    }
+
 def get_sales_analytics(conn, period='all'):
     """Get sales analytics for different time periods, including returns and product summary."""
     if conn is None:
-        print("Error: Database connection is None in get_sales_analytics.")
+        logger.error("Database connection is None in get_sales_analytics.")
         return [] 
 
     cur = conn.cursor()
@@ -189,124 +319,39 @@ def get_sales_analytics(conn, period='all'):
     results = []
 
     try:
+        # Day keys use date.isoformat(), which gives the same 'YYYY-MM-DD' as strftime('%Y-%m-%d')
+        # without going through the locale-aware formatter
         if period == 'daily':
-            for i in range(7):
-                date_obj = today_utc - timedelta(days=i)
-                date_str = date_obj.strftime('%Y-%m-%d')
-                cur.execute("SELECT SUM(s.quantity * s.sale_price) FROM sales s WHERE DATE(s.sale_date) = ?", (date_str,))
-                gross_sales = cur.fetchone()[0] or 0.0
-                
-                # Sum distinct discount_applied_to_bill per bill_identifier for the day
-                cur.execute("""
-                    SELECT SUM(unique_discounts.discount_amount)
-                    FROM (
-                        SELECT DISTINCT s.bill_identifier, s.discount_applied_to_bill AS discount_amount
-                        FROM sales s
-                        WHERE DATE(s.sale_date) = ? AND s.discount_applied_to_bill > 0
-                    ) unique_discounts
-                """, (date_str,))
-                total_discounts_on_bills = cur.fetchone()[0] or 0.0
-
-                cur.execute("SELECT SUM(r.quantity * r.return_price) FROM returns r WHERE DATE(r.return_date) = ?", (date_str,))
-                total_returns_value = cur.fetchone()[0] or 0.0
-                
-                net_sales = gross_sales - total_discounts_on_bills - total_returns_value
-                results.append({
-                    'date': date_str, 'total_sales': round(gross_sales, 2), # This is Gross Sales
-                    'total_discounts_on_bills': round(total_discounts_on_bills, 2),
-                    'total_returns_value': round(total_returns_value, 2), 
-                    'net_sales': round(net_sales, 2)
-                })
+            dates = [(today_utc - timedelta(days=i)).isoformat() for i in range(7)]
+            totals = _period_totals(cur, 'daily', dates[-1])
+            for date_str in dates:
+                results.append({'date': date_str, **_period_row(totals, date_str)})
         elif period == 'weekly':
-            for i in range(4):
-                ref_date = today_utc - timedelta(weeks=i)
-                start_date = ref_date - timedelta(days=ref_date.isoweekday() - 1)
-                end_date = start_date + timedelta(days=6)
-                start_date_str, end_date_str = start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')
-                cur.execute("SELECT SUM(s.quantity * s.sale_price) FROM sales s WHERE DATE(s.sale_date) BETWEEN ? AND ?", (start_date_str, end_date_str,))
-                gross_sales = cur.fetchone()[0] or 0.0
-
-                cur.execute("""
-                    SELECT SUM(unique_discounts.discount_amount)
-                    FROM (
-                        SELECT DISTINCT s.bill_identifier, s.discount_applied_to_bill AS discount_amount
-                        FROM sales s
-                        WHERE DATE(s.sale_date) BETWEEN ? AND ? AND s.discount_applied_to_bill > 0
-                    ) unique_discounts
-                """, (start_date_str, end_date_str))
-                total_discounts_on_bills = cur.fetchone()[0] or 0.0
-
-                cur.execute("SELECT SUM(r.quantity * r.return_price) FROM returns r WHERE DATE(r.return_date) BETWEEN ? AND ?", (start_date_str, end_date_str,))
-                total_returns_value = cur.fetchone()[0] or 0.0
-                
-                net_sales = gross_sales - total_discounts_on_bills - total_returns_value
+            this_week_start = today_utc - timedelta(days=today_utc.isoweekday() - 1)
+            week_starts = [this_week_start - timedelta(weeks=i) for i in range(4)]
+            totals = _period_totals(cur, 'weekly', week_starts[-1].isoformat())
+            week_span = timedelta(days=6)
+            for start_date in week_starts:
+                start_date_str = start_date.isoformat()
+                end_date_str = (start_date + week_span).isoformat()
                 results.append({
                     'week': start_date_str, 'week_start': start_date_str, 'week_end': end_date_str,
-                    'total_sales': round(gross_sales, 2), 
-                    'total_discounts_on_bills': round(total_discounts_on_bills, 2),
-                    'total_returns_value': round(total_returns_value, 2),
-                    'net_sales': round(net_sales, 2)
+                    **_period_row(totals, start_date_str)
                 })
         elif period == 'monthly':
-            current_year, current_month = today_utc.year, today_utc.month
-            for i in range(12):
-                year, month = current_year, current_month - i
-                while month <= 0: month += 12; year -= 1
-                month_str, year_str = str(month).zfill(2), str(year)
-                cur.execute("SELECT SUM(s.quantity * s.sale_price) FROM sales s WHERE strftime('%Y', s.sale_date) = ? AND strftime('%m', s.sale_date) = ?", (year_str, month_str,))
-                gross_sales = cur.fetchone()[0] or 0.0
-
-                cur.execute("""
-                    SELECT SUM(unique_discounts.discount_amount)
-                    FROM (
-                        SELECT DISTINCT s.bill_identifier, s.discount_applied_to_bill AS discount_amount
-                        FROM sales s
-                        WHERE strftime('%Y', s.sale_date) = ? AND strftime('%m', s.sale_date) = ? AND s.discount_applied_to_bill > 0
-                    ) unique_discounts
-                """, (year_str, month_str))
-                total_discounts_on_bills = cur.fetchone()[0] or 0.0
-
-                cur.execute("SELECT SUM(r.quantity * r.return_price) FROM returns r WHERE strftime('%Y', r.return_date) = ? AND strftime('%m', r.return_date) = ?", (year_str, month_str,))
-                total_returns_value = cur.fetchone()[0] or 0.0
-                
-                net_sales = gross_sales - total_discounts_on_bills - total_returns_value
-                results.append({
-                    'month': f"{year_str}-{month_str}", 'total_sales': round(gross_sales, 2),
-                    'total_discounts_on_bills': round(total_discounts_on_bills, 2),
-                    'total_returns_value': round(total_returns_value, 2), 
-                    'net_sales': round(net_sales, 2)
-                })
+            # Count months from year 0 so stepping back across January is a plain divmod
+            current_month_index = today_utc.year * 12 + today_utc.month - 1
+            months = [f"{year}-{month + 1:02d}" for year, month in
+                      (divmod(current_month_index - i, 12) for i in range(12))]
+            totals = _period_totals(cur, 'monthly', months[-1] + "-01")
+            for month_key in months:
+                results.append({'month': month_key, **_period_row(totals, month_key)})
         elif period == 'yearly':
-            cur.execute("SELECT strftime('%Y', s.sale_date) as year, SUM(s.quantity * s.sale_price) as gross_sales_yearly FROM sales s WHERE s.sale_date IS NOT NULL GROUP BY year ORDER BY year DESC")
-            fetched_gross_sales = cur.fetchall()
-            
-            cur.execute("""
-                SELECT strftime('%Y', s.sale_date) as year, SUM(unique_discounts.discount_amount) as total_discount_yearly
-                FROM (
-                    SELECT DISTINCT s.bill_identifier, s.discount_applied_to_bill AS discount_amount, strftime('%Y', s.sale_date) as sale_year
-                    FROM sales s
-                    WHERE s.sale_date IS NOT NULL AND s.discount_applied_to_bill > 0
-                ) unique_discounts
-                GROUP BY sale_year ORDER BY sale_year DESC
-            """)
-            fetched_discounts = {row['year']: row['total_discount_yearly'] for row in cur.fetchall() if row['year']}
-
-            cur.execute("SELECT strftime('%Y', r.return_date) as year, SUM(r.quantity * r.return_price) as total_returns_yearly FROM returns r WHERE r.return_date IS NOT NULL GROUP BY year ORDER BY year DESC")
-            fetched_returns = {row['year']: row['total_returns_yearly'] for row in cur.fetchall() if row['year']}
-            
-            for row_gross in fetched_gross_sales:
-                year_val = row_gross['year']
-                if year_val:
-                    gross_sales = row_gross['gross_sales_yearly'] or 0.0
-                    total_discounts_on_bills = fetched_discounts.get(year_val, 0.0)
-                    total_returns_value = fetched_returns.get(year_val, 0.0)
-                    net_sales = gross_sales - total_discounts_on_bills - total_returns_value
-                    results.append({
-                        'year': year_val, 'total_sales': round(gross_sales, 2),
-                        'total_discounts_on_bills': round(total_discounts_on_bills, 2),
-                        'total_returns_value': round(total_returns_value, 2), 
-                        'net_sales': round(net_sales, 2)
-                    })
+            # '' sorts before every day, so this covers the whole roll-up; as before, only years
+            # with sales are listed
+            totals = _period_totals(cur, 'yearly', '')
+            for year_val in sorted((year for year, (gross, _, _) in totals.items() if year and gross), reverse=True):
+                results.append({'year': year_val, **_period_row(totals, year_val)})
         elif period == 'best_sellers': # Based on gross units sold
             cur.execute("""
                 SELECT p.id, p.name, SUM(s.quantity) as total_sold,
@@ -337,52 +382,141 @@ def get_sales_analytics(conn, period='all'):
                     'category': row[5] if row[5] else 'Uncategorized'
                 })
         elif period == 'product_summary':
+            # Sales and returns are pre-aggregated per product, and the per-product arithmetic
+            # (net units, gross profit at current cost_price) is done by SQLite in the same pass,
+            # so the Python loop below only rounds and builds the result dicts
             cur.execute("""
                 SELECT
-                    p.id, p.name, p.barcode, p.cost_price, p.selling_price,
+                    p.id, p.name, p.barcode,
+                    COALESCE(p.cost_price, 0.0) as cost_price,
+                    COALESCE(p.selling_price, 0.0) as selling_price,
                     p.quantity as current_stock,
                     COALESCE(c.name, 'Uncategorized') as category_name,
-                    SUM(CASE WHEN s.id IS NOT NULL THEN s.quantity ELSE 0 END) as total_units_sold_gross,
-                    SUM(CASE WHEN s.id IS NOT NULL THEN s.quantity * s.sale_price ELSE 0 END) as total_revenue_generated
+                    COALESCE(sold.qty, 0) as total_units_sold_gross,
+                    COALESCE(ret.qty, 0) as total_units_returned,
+                    COALESCE(sold.qty, 0) - COALESCE(ret.qty, 0) as net_units_sold,
+                    COALESCE(sold.revenue, 0.0) as total_revenue_generated,
+                    COALESCE(sold.revenue, 0.0) - COALESCE(p.cost_price, 0.0) * COALESCE(sold.qty, 0) as profit_generated_gross
                 FROM products p
                 LEFT JOIN categories c ON p.category_id = c.id
-                LEFT JOIN sales s ON p.id = s.product_id
-                GROUP BY p.id, p.name, p.barcode, p.cost_price, p.selling_price, p.quantity, c.name
+                LEFT JOIN (SELECT product_id, SUM(quantity) as qty, SUM(quantity * sale_price) as revenue
+                           FROM sales GROUP BY product_id) sold ON sold.product_id = p.id
+                LEFT JOIN (SELECT product_id, SUM(quantity) as qty FROM returns GROUP BY product_id) ret ON ret.product_id = p.id
                 ORDER BY p.name COLLATE NOCASE
             """)
-            fetched_products = cur.fetchall()
-            for row_dict in fetched_products: # cur.fetchall() already gives list of dicts if row_factory is sqlite3.Row
-                row = dict(row_dict) # Ensure it's a mutable dict if needed
-                cost_price = row.get('cost_price', 0.0) or 0.0
-                selling_price = row.get('selling_price', 0.0) or 0.0
-                total_units_sold_gross = row.get('total_units_sold_gross', 0) or 0
-                total_revenue = row.get('total_revenue_generated', 0.0) or 0.0
-                
-                total_cost_of_goods_sold = cost_price * total_units_sold_gross
-                profit_gross = total_revenue - total_cost_of_goods_sold
-                
-                cur.execute("SELECT SUM(r.quantity) FROM returns r WHERE r.product_id = ?", (row['id'],))
-                total_units_returned = cur.fetchone()[0] or 0
-                net_units_sold = total_units_sold_gross - total_units_returned
-
-                results.append({
-                    'id': row['id'], 'name': row['name'], 'barcode': row['barcode'],
-                    'category_name': row['category_name'], 'cost_price': round(cost_price, 2),
-                    'selling_price': round(selling_price, 2), 'current_stock': row['current_stock'],
+            # Rows are unpacked in SELECT-list order; no per-row dict copy
+            results = [
+                {
+                    'id': product_id, 'name': name, 'barcode': barcode_value,
+                    'category_name': category_name, 'cost_price': round(cost_price, 2),
+                    'selling_price': round(selling_price, 2), 'current_stock': current_stock,
                     'total_units_sold_gross': total_units_sold_gross,
                     'total_units_returned': total_units_returned,
                     'net_units_sold': net_units_sold,
                     'total_revenue_generated': round(total_revenue, 2),
                     'profit_generated_gross': round(profit_gross, 2)
-                })
+                }
+                for (product_id, name, barcode_value, cost_price, selling_price, current_stock, category_name,
+                     total_units_sold_gross, total_units_returned, net_units_sold, total_revenue, profit_gross) in cur.fetchall()
+            ]
 
-    except sqlite3.Error as e:
-        print(f"Database error during analytics query for period '{period}': {e}")
+    except sqlite3.Error:
+        logger.exception("Database error during analytics query for period '%s'", period)
         return [] 
-    except Exception as e: 
-        print(f"Unexpected error during analytics generation for period '{period}': {e}")
-        import traceback
-        traceback.print_exc() 
+    except Exception: 
+        logger.exception("Unexpected error during analytics generation for period '%s'", period)
         return [] 
 
+    return results
+
+
+def _cache_get(key):
+    with _analytics_cache_lock:
+        entry = _analytics_cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del _analytics_cache[key]
+            return None
+        return entry[1]
+
+def _cache_set(key, result, ttl):
+    with _analytics_cache_lock:
+        now = time.monotonic()
+        if len(_analytics_cache) >= ANALYTICS_CACHE_MAXSIZE:
+            for stale_key in [k for k, (expires_at, _) in _analytics_cache.items() if expires_at < now]:
+                del _analytics_cache[stale_key]
+            while len(_analytics_cache) >= ANALYTICS_CACHE_MAXSIZE:
+                del _analytics_cache[next(iter(_analytics_cache))] # Oldest insertion first
+        _analytics_cache[key] = (now + ttl, result)
+
+def clear_analytics_cache():
+    """Drops every cached analytics result. Call after writes to sales, products or returns."""
+    with _analytics_cache_lock:
+        _analytics_cache.clear()
+
+def _sales_stamp(conn):
+    """Newest sales id: one index probe that changes whenever a sale is recorded."""
+    try:
+        return conn.execute("SELECT MAX(id) FROM sales").fetchone()[0]
+    except sqlite3.Error:
+        return None
+
+def _sales_cache_key(period, sales_stamp=None):
+    if period in SALES_STAMPED_PERIODS:
+        return ('sales', period, sales_stamp)
+    return ('sales', period, datetime.now(UTC).date().isoformat())
+
+def get_cached_sales_analytics(conn, period='all'):
+    """
+    get_sales_analytics() memoized per (period, UTC day) for ANALYTICS_CACHE_TTL seconds, or
+    per (period, newest sales id) for SALES_STAMPED_CACHE_TTL for SALES_STAMPED_PERIODS.
+    """
+    stamped = period in SALES_STAMPED_PERIODS
+    key = _sales_cache_key(period, _sales_stamp(conn) if stamped else None)
+    result = _cache_get(key)
+    if result is None:
+        result = get_sales_analytics(conn, period)
+        _cache_set(key, result, SALES_STAMPED_CACHE_TTL if stamped else ANALYTICS_CACHE_TTL)
+    return result
+
+def get_cached_custom_range_analytics(conn, from_date_str: str, to_date_str: str):
+    """get_custom_range_analytics() memoized per (from_date, to_date). Error results are not cached."""
+    key = ('custom_range', from_date_str, to_date_str)
+    result = _cache_get(key)
+    if result is None:
+        result = get_custom_range_analytics(conn, from_date_str, to_date_str)
+        if result is not None and not result.get("error"):
+            _cache_set(key, result, CUSTOM_RANGE_CACHE_TTL)
+    return result
+
+def _sales_analytics_on_pooled_connection(period):
+    conn = acquire_connection()
+    try:
+        return get_cached_sales_analytics(conn, period)
+    finally:
+        release_connection(conn)
+
+def get_sales_analytics_bulk(conn, metrics=DASHBOARD_METRICS):
+    """
+    Fetches several get_sales_analytics() periods in one call and returns {metric: rows}.
+    Cached metrics come straight from memory; when more than one is missing they
+    run concurrently, each on its own pooled connection, instead of back to back on `conn`.
+    """
+    results = {}
+    missing = []
+    sales_stamp = _sales_stamp(conn) if any(metric in SALES_STAMPED_PERIODS for metric in metrics) else None
+    for metric in metrics:
+        cached = _cache_get(_sales_cache_key(metric, sales_stamp))
+        if cached is None:
+            missing.append(metric)
+        else:
+            results[metric] = cached
+
+    if len(missing) == 1:
+        results[missing[0]] = get_cached_sales_analytics(conn, missing[0])
+    elif missing:
+        futures = {metric: _analytics_executor.submit(_sales_analytics_on_pooled_connection, metric) for metric in missing}
+        for metric, future in futures.items():
+            results[metric] = future.result()
     return results
\ No newline at end of file